@@ -0,0 +1,91 @@
+# Benchmark of how long bpt takes to start.  Runs Python with -X importtime to
+# import bpt in a fresh interpreter several times, then reports the fastest
+# cumulative import time of bpt and its heaviest dependencies along with the
+# wall-clock time of 'bpt.py --help'.  Also fails if a module that should only
+# be imported on demand (like GitPython) is imported at startup, so regressions
+# are caught.
+#
+# Run from the root of the repository:
+#   python3 benchmarks/import_time.py --repeat 10
+import os
+import subprocess
+import sys
+import time
+
+import click
+
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+bench_format = '| {:28} | {:>10} | {:>10} |'
+bench_separator = '-' * 56
+
+# Modules that are slow to import and must only be imported when needed.
+deferred_modules = ('git', 'pkg_resources', 'http.server')
+
+
+def import_times(module):
+    """Import module in a fresh interpreter with -X importtime and return a
+    dict of the cumulative import time in microseconds of every module that
+    was imported.
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        cwd=root, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True,
+        check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        # Lines look like 'import time:  self [us] | cumulative | imported package'.
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        times[fields[2].strip()] = int(fields[1])
+    return times
+
+
+def help_time():
+    """Return the wall-clock seconds to run 'bpt.py --help'."""
+    start = time.perf_counter()
+    subprocess.run([sys.executable, 'bpt.py', '--help'], cwd=root, stdout=subprocess.DEVNULL,
+        check=True)
+    return time.perf_counter() - start
+
+
+@click.command()
+@click.option('--repeat', '-r', type=click.IntRange(min=1), default=5,
+    help='Number of times to run each measurement, the fastest is reported.')
+@click.option('--module', '-m', 'modules', multiple=True,
+    help='Also report the import time of this module, can be specified more than once.')
+@click.option('--max-ms', type=click.FloatRange(min=0),
+    help='Fail if importing bpt takes longer than this many milliseconds.')
+def main(repeat, modules, max_ms):
+    # Import once first so bytecode caches are warm for every measured run.
+    import_times('bpt')
+    runs = [import_times('bpt') for i in range(repeat)]
+    report = ['bpt', 'bpt_model', 'click', 'concurrent.futures', 'orjson'] + list(modules)
+    click.echo(bench_separator)
+    click.echo(bench_format.format('Module', 'Best (ms)', 'Worst (ms)'))
+    click.echo(bench_separator)
+    for module in report:
+        times = [x[module] for x in runs if module in x]
+        if len(times) == 0:
+            click.echo(bench_format.format(module, 'not loaded', ''))
+            continue
+        click.echo(bench_format.format(module, '{:.1f}'.format(min(times)/1000),
+            '{:.1f}'.format(max(times)/1000)))
+    times = [help_time() for i in range(repeat)]
+    click.echo(bench_format.format('bpt.py --help (wall)', '{:.1f}'.format(min(times)*1000),
+        '{:.1f}'.format(max(times)*1000)))
+    click.echo(bench_separator)
+    loaded = [x for x in deferred_modules if x in runs[0]]
+    if len(loaded) > 0:
+        raise click.ClickException('Modules that should be deferred were imported at startup: {0}'.format(
+            ', '.join(loaded)))
+    best = min(x['bpt'] for x in runs)/1000
+    if max_ms is not None and best > max_ms:
+        raise click.ClickException('Importing bpt took {0:.1f} ms, more than {1:.1f} ms!'.format(best, max_ms))
+
+
+if __name__ == '__main__':
+    main()
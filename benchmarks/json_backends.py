@@ -0,0 +1,84 @@
+# Benchmark of the bpt JSON backends on scaled up copies of a board index.
+# Each package in the index is duplicated (with a unique name) to simulate the
+# large indices that aggregate several vendors, then every available backend
+# loads and dumps the result.  Also checks that all backends write exactly the
+# same bytes.
+#
+# Run from the root of the repository:
+#   python3 benchmarks/json_backends.py --scale 10 --scale 100
+import copy
+import os
+import sys
+import time
+
+import click
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bpt_model import JSONBackend, OrjsonBackend, orjson
+
+
+bench_format = '| {:>6} | {:8} | {:>9} | {:>9} | {:>9} |'
+bench_separator = '-' * 58
+
+
+def scale_index(index, scale):
+    """Return a copy of the board index data with every package repeated
+    scale times.
+    """
+    packages = []
+    for i in range(scale):
+        for package in index.get('packages', []):
+            package = copy.deepcopy(package)
+            if i > 0:
+                package['name'] = '{0}-{1}'.format(package['name'], i)
+            packages.append(package)
+    return {'packages': packages}
+
+
+def best_time(func, repeat):
+    """Return the fastest wall-clock time in seconds of repeat calls to func."""
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+@click.command()
+@click.option('--board-index', '-i', default='package_adafruit_index.json',
+    type=click.Path(exists=True, dir_okay=False),
+    help='Board index JSON file to scale up.')
+@click.option('--scale', '-s', type=click.IntRange(min=1), multiple=True,
+    help='Number of copies of the index to benchmark, can be specified more than once.  Default is 1, 10 and 100.')
+@click.option('--repeat', '-r', type=click.IntRange(min=1), default=3,
+    help='Number of times to run each measurement, the fastest is reported.')
+def main(board_index, scale, repeat):
+    backends = [JSONBackend()]
+    if orjson is not None:
+        backends.append(OrjsonBackend())
+    else:
+        click.echo('orjson is not installed, only benchmarking the json module.')
+    with open(board_index, 'rb') as bi:
+        index = JSONBackend().loads(bi.read())
+    click.echo(bench_separator)
+    click.echo(bench_format.format('Scale', 'Backend', 'Size (MB)', 'Load (s)', 'Dump (s)'))
+    click.echo(bench_separator)
+    for factor in scale or (1, 10, 100):
+        data = JSONBackend().dumps(scale_index(index, factor)).encode('utf-8')
+        outputs = []
+        for backend in backends:
+            load_time = best_time(lambda: backend.loads(data), repeat)
+            decoded = backend.loads(data)
+            dump_time = best_time(lambda: backend.dumps(decoded), repeat)
+            outputs.append(backend.dumps(decoded).encode('utf-8'))
+            click.echo(bench_format.format(factor, backend.name,
+                '{:.1f}'.format(len(data)/(1024*1024)),
+                '{:.3f}'.format(load_time), '{:.3f}'.format(dump_time)))
+        if any(map(lambda x: x != data, outputs)):
+            raise click.ClickException('Backends wrote different JSON at scale {0}!'.format(factor))
+    click.echo(bench_separator)
+
+
+if __name__ == '__main__':
+    main()
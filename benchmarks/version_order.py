@@ -0,0 +1,73 @@
+# Check that bpt's version parser orders versions the same as the packaging
+# library (PEP 440).  Compares every pair of a list of tricky versions (pre,
+# post, implicit post, dev, local and epoch versions) plus every platform
+# version in the board index, and fails if any pair is ordered differently so
+# regressions are caught.
+#
+# Needs the packaging library (pip install packaging).  Run from the root of
+# the repository:
+#   python3 benchmarks/version_order.py
+import itertools
+import json
+import os
+import sys
+
+import click
+
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)
+
+from bpt_model import Version
+
+
+# Versions that are easy to get wrong, all valid PEP 440 versions.
+versions = [
+    '0.9', '1', '1.0', '1.0.0', '1.0.0.0', 'v1.0', '1.0.1', '1.1', '1.10', '1.2.10', '2.0',
+    '1.0a1', '1.0.0-alpha2', '1.0b1', '1.0.0-beta.2', '1.0c1', '1.0rc1', '1.0.0-rc2', '1.0pre3',
+    '1.0.dev1', '1.0a1.dev1', '1.0.post1.dev1', '1.0rc1.post1',
+    '1.0.post1', '1.0.0.post2', '1.0-1', '1.0.0-1', '1.0-2', '1.0.0-10', '1.0rev3', '1.0r4',
+    '1.0+local', '1.0+1', '1.0+abc.2', '1.0.0-1+local',
+    '0!1.0', '1!0.1', '1!1.0', '2!0.0.1',
+]
+
+
+def index_versions(index_file):
+    """Return the platform versions of the board index at index_file."""
+    with open(index_file, 'r') as index:
+        data = json.load(index)
+    return [x['version'] for package in data['packages'] for x in package.get('platforms', [])]
+
+
+def compare(a, b):
+    """Return -1, 0 or 1 like the old cmp builtin."""
+    return (a > b) - (a < b)
+
+
+@click.command()
+@click.option('--board-index', '-i', default=os.path.join(root, 'package_adafruit_index.json'),
+    type=click.Path(exists=True, dir_okay=False),
+    help='Also compare every platform version in this board index.')
+def main(board_index):
+    try:
+        from packaging.version import Version as PackagingVersion
+    except ImportError:
+        raise click.ClickException('The packaging library is needed, install it with: pip install packaging')
+    all_versions = sorted(set(versions + index_versions(board_index)))
+    mismatches = []
+    for a, b in itertools.combinations(all_versions, 2):
+        expected = compare(PackagingVersion(a), PackagingVersion(b))
+        actual = compare(Version(a), Version(b))
+        if actual != expected:
+            mismatches.append((a, b, actual, expected))
+    click.echo('Compared {0} pairs of {1} versions.'.format(
+        len(all_versions)*(len(all_versions) - 1)//2, len(all_versions)))
+    if len(mismatches) > 0:
+        for a, b, actual, expected in mismatches:
+            click.echo('- {0} vs {1}: bpt says {2}, packaging says {3}'.format(a, b, actual, expected))
+        raise click.ClickException('{0} pairs of versions are ordered differently!'.format(len(mismatches)))
+    click.echo('All versions are ordered the same as packaging.')
+
+
+if __name__ == '__main__':
+    main()
@@ -22,14 +22,13 @@
 # COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
 # IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import collections
+import concurrent.futures
+import cProfile
 import json
-import http.server
-import socketserver
 
 from bpt_model import *
 import click
-from git import Repo
-from pkg_resources import parse_version
 
 
 logger = logging.getLogger(__name__)
@@ -43,24 +42,39 @@ class BptContext(object):
     def __init__(self):
         self.board_config_file = None
         self.board_index_file = None
-        self.board_packages = None
+        self.jobs = 4
+        self.mirror_cache = None
+        self.json_backend = None
         self.board_config = None
         self.board_index = None
 
-    def load_data(self):
+    def load_data(self, streaming=False):
         """Load all the package and package index metadata to prepare for
-        processing.  This will read the package config INI file and all grab all
-        the packages it mentions, then load the package index JSON and parse it.
+        processing.  This will read the package config INI file, then load the
+        package index JSON and parse it.  Packages mentioned in the config are
+        only grabbed from their origin when a command asks for them.  If
+        streaming is True the index is loaded as a read-only
+        StreamingBoardIndex.
         """
-        click.echo('Loading current packages from their origin repository/directory...')
         # Load the board configuration file.
-        self.board_config = BoardConfig(self.board_config_file)
-        # Save the board packages in the context so other commands can read and
-        # process them.
-        self.board_packages = self.board_config.get_packages()
+        with profile_phase('BoardConfig', self.board_config_file):
+            self.board_config = BoardConfig(self.board_config_file, max_workers=self.jobs,
+                mirror_cache=self.mirror_cache)
         # Now read in the board index JSON file and parse it, then save in global context.
-        with open(self.board_index_file, 'r') as bi:
-            self.board_index = BoardIndex(json.load(bi))
+        self.board_index = self.read_board_index(streaming=streaming)
+
+    def read_board_index(self, streaming=False):
+        """Read the board index JSON file and return it parsed as a BoardIndex.
+        If streaming is True return a read-only StreamingBoardIndex instead,
+        which uses much less memory for large indices.
+        """
+        if streaming:
+            with profile_phase('read_index', self.board_index_file):
+                return StreamingBoardIndex(self.board_index_file, json_backend=self.json_backend)
+        with profile_phase('read_index', self.board_index_file), \
+             open(self.board_index_file, 'rb') as bi:
+            return BoardIndex(self.json_backend.loads(bi.read()),
+                json_backend=self.json_backend, source_file=self.board_index_file)
 
 
 @click.group()
@@ -72,8 +86,24 @@ class BptContext(object):
 @click.option('--board-index', '-i', default='package_adafruit_index.json',
     type=click.Path(exists=True, dir_okay=False),
     help='Specify a board index JSON file.  This is the master index that publishes all the packages.')
+@click.option('--jobs', '-j', type=click.IntRange(min=1), default=4,
+    help='Maximum number of board packages to load from their origin at the same time.  Default is 4.')
+@click.option('--mirror-cache', '-m', envvar='BPT_MIRROR_CACHE',
+    type=click.Path(file_okay=False, writable=True),
+    help='Specify a directory to keep persistent mirrors of board package Git repositories.  Repeat runs only fetch new commits instead of cloning from scratch.  Can also be set with the BPT_MIRROR_CACHE environment variable.')
+@click.option('--mirror-cache-size', type=click.IntRange(min=0), default=None,
+    help='Maximum size in megabytes of the mirror cache.  Least recently used mirrors are deleted when the cache grows beyond this size.  Default is no limit.')
+@click.option('--json-backend', type=click.Choice(['auto', 'json', 'orjson']), default='auto',
+    help="JSON library used to read and write the board index.  Default is 'auto' which uses orjson if it's installed and Python's json module otherwise.  Both write identical files.")
+@click.option('--profile', is_flag=True,
+    help='Print how long each phase of the command (loading the config, cloning, writing archives, hashing, writing JSON) took and the peak memory use when it finished.')
+@click.option('--profile-trace', type=click.Path(dir_okay=False, writable=True),
+    help='Write the profiled phases to this file in the Chrome trace JSON format (viewable in chrome://tracing or Perfetto).  Implies --profile.')
+@click.option('--profile-stats', type=click.Path(dir_okay=False, writable=True),
+    help='Write cProfile statistics of the command to this file, for use with pstats or snakeviz.  Only code running in the main thread is profiled.  Implies --profile.')
 @click.pass_context
-def bpt_command(ctx, debug, board_config, board_index):
+def bpt_command(ctx, debug, board_config, board_index, jobs, mirror_cache, mirror_cache_size,
+                json_backend, profile, profile_trace, profile_stats):
     """Adafruit Arduino Board Package Tool (bpt)
 
     Swiss Army knife for managing Arduino board packages.  Can check board packages
@@ -84,6 +114,45 @@ def bpt_command(ctx, debug, board_config, board_index):
         logging.basicConfig(level=logging.DEBUG)
     ctx.obj.board_config_file = board_config
     ctx.obj.board_index_file = board_index
+    ctx.obj.jobs = jobs
+    try:
+        ctx.obj.json_backend = get_json_backend(json_backend)
+    except RuntimeError as ex:
+        raise click.BadParameter(str(ex), param_hint='--json-backend')
+    if mirror_cache is not None:
+        max_size = None
+        if mirror_cache_size is not None:
+            max_size = mirror_cache_size*1024*1024
+        ctx.obj.mirror_cache = GitMirrorCache(mirror_cache, max_size=max_size)
+    if profile or profile_trace is not None or profile_stats is not None:
+        start_profiling(ctx, profile_trace, profile_stats)
+
+
+def start_profiling(ctx, profile_trace, profile_stats):
+    """Record the phases of the command and print a summary when it's done,
+    optionally writing a Chrome trace and cProfile statistics too.
+    """
+    profiler = PhaseProfiler()
+    set_profiler(profiler)
+    stats = None
+    if profile_stats is not None:
+        stats = cProfile.Profile()
+        stats.enable()
+    def finish():
+        if stats is not None:
+            stats.disable()
+            stats.dump_stats(profile_stats)
+        set_profiler(None)
+        megabytes = lambda x: '' if x is None else '{0:.1f}'.format(x/(1024*1024))
+        click.echo('{0:<16} {1:>6} {2:>10} {3:>10} {4:>14} {5:>14}'.format('Phase', 'Count',
+            'Total s', 'Max s', 'Peak RSS MB', 'Peak growth MB'), err=True)
+        for totals in profiler.get_summary():
+            click.echo('{0:<16} {1:>6} {2:>10.3f} {3:>10.3f} {4:>14} {5:>14}'.format(totals['name'],
+                totals['count'], totals['total'], totals['max'], megabytes(totals['peak_rss']),
+                megabytes(totals['peak_growth'])), err=True)
+        if profile_trace is not None:
+            profiler.write_chrome_trace(profile_trace)
+    ctx.call_on_close(finish)
 
 
 @bpt_command.command()
@@ -95,9 +164,15 @@ def check_updates(ctx):
     recent version published in a board index.  Will alert of any board packages
     which have a newer version than is published in the board index.
     """
-    ctx.obj.load_data()  # Load all the package config & metadata.
+    # Load all the package config & metadata.  Only the latest versions in the
+    # index are needed so it's streamed instead of decoded whole.
+    ctx.obj.load_data(streaming=True)
+    click.echo('Reading current package versions from their origin repository/directory...')
+    # Only the versions are needed so probe the packages instead of checking
+    # out all of their files.
+    board_packages = ctx.obj.board_config.probe_packages()
     click.echo('Found the following current packages:')
-    for package in ctx.obj.board_packages:
+    for package in board_packages:
         click.echo('- {0}'.format(package.get_name()))
         click.echo('    version = {0}'.format(package.get_version()))
         click.echo('    origin  = {0}'.format(package.get_origin()))
@@ -105,20 +180,15 @@ def check_updates(ctx):
     # and check if its version is newer than the related packages in the board
     # index.
     click.echo('Comparing current packages with published versions in board index...')
-    for package in ctx.obj.board_packages:
-        parent = package.get_parent()
+    for package in board_packages:
         name = package.get_name()
         version = package.get_version()
         click.echo('- {0}'.format(name))
-        # Get all the associated packages in the board index.
-        index_packages = list(ctx.obj.board_index.get_platforms(parent, name))
+        latest = ctx.obj.board_index.latest_version(package.get_parent(), package.get_name())
         # Skip to the next package if nothing was found in the board index for this package.
-        if len(index_packages) == 0:
+        if latest is None:
             click.echo('    Not found in board index!')
             continue
-        # Find the most recent version in the index packages.
-        #print(index_packages)
-        latest = max(map(lambda x: parse_version(x.get('version', '')), index_packages))
         click.echo('    latest index version = {0}'.format(str(latest)))
         # Warn if the latest published package is older than the current package
         # from its origin source.
@@ -128,77 +198,186 @@ def check_updates(ctx):
 
 @bpt_command.command()
 @click.option('--force', '-f', is_flag=True,
-              help='Force the specified package to be updated even if the version is older than currently in the index.')
+              help='Force the specified packages to be updated even if the version is older than currently in the index.')
+@click.option('--all', '-a', 'update_all', is_flag=True,
+              help='Update every package in the board package config INI file that has a newer version than currently in the index.')
 @click.option('--output-board-index', '-o',
     type=click.Path(dir_okay=False, writable=True),
     help='Specify the new board index JSON file to write.  If not specified the input board index (--board-index value or its default) will be used.')
 @click.option('--output-board-dir', '-od', default='boards',
     type=click.Path(file_okay=False, writable=True),
-    help="Specify the directory to write the board package archive file.  Default is a 'boards' subdirectory in the current location.")
-@click.argument('package_name')
+    help="Specify the directory to write the board package archive files.  Default is a 'boards' subdirectory in the current location.")
+@click.option('--compress-jobs', type=click.IntRange(min=0), default=1,
+    help='Number of processes to use when compressing each board package archive.  Use 0 for one per CPU core.  Default is 1 which compresses in a single process.')
+@click.option('--deterministic', is_flag=True,
+    help='Build reproducible archives with fixed timestamps and owners, so unchanged package contents always produce identical archive bytes.')
+@click.option('--build-cache', envvar='BPT_BUILD_CACHE',
+    type=click.Path(file_okay=False, writable=True),
+    help='Specify a directory to cache built archives in.  An unchanged package reuses its cached archive and checksum instead of compressing it again.  Implies --deterministic.  Can also be set with the BPT_BUILD_CACHE environment variable.')
+@click.argument('package_names', metavar='[PACKAGE_NAME]...', nargs=-1)
 @click.pass_context
-def update_index(ctx, package_name, force, output_board_index, output_board_dir):
-    """Update board package in the published index.
+def update_index(ctx, package_names, force, update_all, output_board_index, output_board_dir,
+                 compress_jobs, deterministic, build_cache):
+    """Update board packages in the published index.
 
-    This command will archive and compress a board package and add it to the
-    board index file.  A sanity check will be done to ensure the package has a
+    This command will archive and compress board packages and add them to the
+    board index file.  A sanity check will be done to ensure each package has a
     later version than currently in the board index, however this can be disabled
     with the --force option.
 
-    The command takes one argument, the name of the board package to update.
-    This should be the name of the package as defined in the board package config
-    INI file section name (use the check_updates command to list all the packages
-    from the config if unsure).
+    The command takes the names of the board packages to update.  These should be
+    the names of the packages as defined in the board package config INI file
+    section names (use the check_updates command to list all the packages from
+    the config if unsure).  Alternatively use the --all option to update every
+    package that is newer than its latest version in the board index.  The
+    archives are built concurrently and the board index is written once with all
+    the new packages.
     """
+    if update_all == (len(package_names) > 0):
+        raise click.UsageError('Specify either the names of the packages to update or the --all option!')
     ctx.obj.load_data()  # Load all the package config & metadata.
     # Use the input board index as the output if none is specified.
     if output_board_index is None:
         output_board_index = ctx.obj.board_index_file
-    # Validate that the specified package exists in the config.
-    package = ctx.obj.board_config.get_package(package_name)
-    if package is None:
-        raise click.BadParameter('Could not find specified package in the board package config INI file! Run check_updates command to list all configured package names.',
-            param_hint='package')
-    # If not in force mode do a sanity check to make sure the package source
+    if update_all:
+        # Find the packages with a newer version than the board index, the same
+        # as check_updates does.
+        click.echo('Reading current package versions from their origin repository/directory...')
+        package_names = []
+        not_in_index = []
+        for package in ctx.obj.board_config.probe_packages():
+            latest = ctx.obj.board_index.latest_version(package.get_parent(), package.get_name())
+            if latest is None:
+                not_in_index.append(package.get_name())
+            elif latest < parse_version(package.get_version()):
+                package_names.append(package.get_name())
+        # Packages that were never published are left alone, adding one to the
+        # index has to be asked for by name.
+        for name in not_in_index:
+            click.echo('- {0}: not in board index, add it manually with: update_index "{0}"'.format(name))
+        if len(package_names) == 0:
+            if len(not_in_index) > 0:
+                click.echo('No packages in the board index are out of date.')
+            else:
+                click.echo('All packages are up to date in the board index.')
+            return
+        click.echo('Found out of date packages: {0}'.format(', '.join(package_names)))
+    # Ignore repeated package names so each package is only built and added to
+    # the index once.
+    package_names = list(collections.OrderedDict.fromkeys(package_names))
+    # Validate that the specified packages exist in the config.
+    for package_name in package_names:
+        if package_name not in ctx.obj.board_config.get_package_names():
+            raise click.BadParameter('Could not find package {0} in the board package config INI file! Run check_updates command to list all configured package names.'.format(package_name),
+                param_hint='package')
+    click.echo('Loading current packages from their origin repository/directory...')
+    packages = ctx.obj.board_config.get_packages(package_names)
+    # If not in force mode do a sanity check to make sure each package source
     # has a newer version than in the index.
     if not force:
-        # Get all the associated packages in the board index.
-        index_packages = list(ctx.obj.board_index.get_platforms(package.get_parent(),
-            package.get_name()))
-        # Do version check if packages were found in the index.
-        if len(index_packages) > 0:
-            # Find the most recent version in the index packages.
-            latest = max(map(lambda x: parse_version(x.get('version', '')), index_packages))
+        for package in packages:
+            latest = ctx.obj.board_index.latest_version(package.get_parent(), package.get_name())
             # Warn if the latest published package is the same or newer than the
             # current package from its origin source.
-            if latest >= parse_version(package.get_version()):
-                raise click.UsageError('Specified package is older than the version currently in the index!  Use the --force option to force this update if necessary.')
+            if latest is not None and latest >= parse_version(package.get_version()):
+                raise click.UsageError('Package {0} is older than the version currently in the index!  Use the --force option to force this update if necessary.'.format(package.get_name()))
     # Create the output directory if it doesn't exist.
     if not os.path.exists(output_board_dir):
         os.makedirs(output_board_dir)
-    # Build the archive with the board package data and write it to the target
-    # directory.
-    archive_path = os.path.join(output_board_dir, package.get_archive_name())
-    size, sha256 = package.write_archive(archive_path)
-    click.echo('Created board package archive: {0}'.format(archive_path))
-    # Convert the package template from JSON to a platform metadata dict that
-    # can be inserted in the board index.
-    template_params = {
-        'version': package.get_version(),
-        'filename': package.get_archive_name(),
-        'sha256': sha256,
-        'size': size
-    }
-    platform = json.loads(package.get_template().format(**template_params))
-    # Add the new pacakge metadata to the board index.
-    ctx.obj.board_index.add_platform(package.get_parent(), platform)
+    # Build the archives with the board package data and write them to the
+    # target directory.
+    if compress_jobs == 0:
+        compress_jobs = os.cpu_count() or 1
+    if build_cache is not None:
+        build_cache = ArchiveBuildCache(build_cache)
+    build = lambda x: build_platform(x, output_board_dir, jobs=compress_jobs,
+        deterministic=deterministic, build_cache=build_cache)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=ctx.obj.jobs) as executor:
+        platforms = list(executor.map(build, packages))
+    for package, platform in zip(packages, platforms):
+        click.echo('Created board package archive: {0}'.format(
+            os.path.join(output_board_dir, package.get_archive_name())))
+        # Add the new pacakge metadata to the board index.
+        ctx.obj.board_index.add_platform(package.get_parent(), platform)
     # Write out the new board index JSON.
-    new_index = ctx.obj.board_index.write_json()
-    with open(output_board_index, 'w') as bi:
-        bi.write(new_index)
+    ctx.obj.board_index.write_file(output_board_index)
     click.echo('Wrote updated board index JSON: {0}'.format(output_board_index))
 
 
+@bpt_command.command()
+@click.option('--output-board-index', '-o',
+    type=click.Path(dir_okay=False, writable=True),
+    help='Specify the board index JSON file to write.  If not specified the input board index (--board-index value or its default) will be used.')
+@click.option('--output-board-dir', '-od', default='boards',
+    type=click.Path(file_okay=False, writable=True),
+    help="Specify the directory to write the board package archive files.  Default is a 'boards' subdirectory in the current location.")
+@click.option('--compress-jobs', type=click.IntRange(min=0), default=1,
+    help='Number of processes to use when compressing each board package archive.  Use 0 for one per CPU core.  Default is 1 which compresses in a single process.')
+@click.option('--deterministic', is_flag=True,
+    help='Build reproducible archives with fixed timestamps and owners, so unchanged package contents always produce identical archive bytes.')
+@click.option('--build-cache', envvar='BPT_BUILD_CACHE',
+    type=click.Path(file_okay=False, writable=True),
+    help='Specify a directory to cache built archives in.  An unchanged package reuses its cached archive and checksum instead of compressing it again.  Implies --deterministic.  Can also be set with the BPT_BUILD_CACHE environment variable.')
+@click.option('--interval', type=click.FloatRange(min=0, min_open=True), default=2,
+    help='Seconds between checks of the platform.txt of directory packages for changes.  Default is 2.')
+@click.option('--git-interval', type=click.FloatRange(min=0), default=300,
+    help='Seconds between polls of the remotes of Git packages for new commits.  Default is 300.')
+@click.option('--control-host', default='127.0.0.1',
+    help='Address the control API listens on.  Default is 127.0.0.1 which only accepts local clients.')
+@click.option('--control-port', type=click.IntRange(min=0, max=65535), default=8001,
+    help='Port number the control API listens on, or 0 to disable it.  Default is 8001.')
+@click.pass_context
+def watch(ctx, output_board_index, output_board_dir, compress_jobs, deterministic, build_cache,
+          interval, git_interval, control_host, control_port):
+    """Keep the board index up to date with the packages.
+
+    Runs until interrupted, keeping the board package config and board index
+    loaded.  Directory packages are checked for changes to their platform.txt
+    every few seconds and the remotes of Git packages are polled for new commits
+    less often.  Like update_index --all, packages with a newer version than
+    the index are rebuilt and added to it, but only packages whose source
+    changed are read again.  Use --mirror-cache to also keep Git mirrors so
+    only new commits are fetched.
+
+    \b
+    A control API listens on http://127.0.0.1:8001 by default:
+      GET  /status  status of the watcher and each package as JSON
+      POST /run     check now (?force=1 reads every package, ?wait=1 responds
+                    when the check is done)
+      POST /stop    stop watching
+    """
+    from bpt_watch import BoardIndexWatcher, WatchControlServer
+    # Use the input board index as the output if none is specified.
+    if output_board_index is None:
+        output_board_index = ctx.obj.board_index_file
+    if compress_jobs == 0:
+        compress_jobs = os.cpu_count() or 1
+    if build_cache is not None:
+        build_cache = ArchiveBuildCache(build_cache)
+    load_config = lambda: BoardConfig(ctx.obj.board_config_file, max_workers=ctx.obj.jobs,
+        mirror_cache=ctx.obj.mirror_cache)
+    watcher = BoardIndexWatcher(load_config, ctx.obj.read_board_index, ctx.obj.board_config_file,
+        ctx.obj.board_index_file, output_board_index, output_board_dir, interval=interval,
+        git_interval=git_interval, jobs=ctx.obj.jobs, echo=click.echo,
+        archive_args=dict(jobs=compress_jobs, deterministic=deterministic, build_cache=build_cache))
+    server = None
+    if control_port != 0:
+        server = WatchControlServer((control_host, control_port), watcher)
+        server.start()
+        click.echo('Control API listening at: http://{0}:{1}/status'.format(control_host, control_port))
+    click.echo('Watching board packages in {0} (press Ctrl-C to stop)...'.format(ctx.obj.board_config_file))
+    try:
+        watcher.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        watcher.close()
+    click.echo('Stopped watching.')
+
+
 @bpt_command.command()
 @click.option('--url-transform', '-u', default='adafruit.github.io/arduino-board-index',
               help='URL domain and starting path to replace with the localhost:<port> test server in the index during testing.  Must be set or else the index will reference files on the internet, not local machine!')
@@ -212,38 +391,471 @@ def test_server(ctx, url_transform, port):
     option) that will serve the board package index.  Setup the Arduino IDE to
     use the board package URL:
       http://localhost:8000/package_test_index.json
+
+    The server handles many clients at once, keeps connections alive and
+    supports resuming downloads with HTTP ranges.  The test board index is
+    served from memory and rebuilt whenever the source board index changes.
     """
     # TODO: Don't hard code this file name.  However Arduino _must_ see a file
     # named 'package_<PACKAGE_NAME>_index.json' for the file to work, and we
     # don't want to modify the real index with the transformations below.  for
     # now we just use a test package file.
     test_index = 'package_test_index.json'
-    ctx.obj.load_data()  # Load all the package config & metadata.
-    # Start the webserver from inside the directory with the index file.
-    index_dir, index_filename = os.path.split(ctx.obj.board_index_file)
-    if index_dir is not None and index_dir != '':
-        os.chdir(index_dir)
-    # Transform all package url values in the index to use http instead of https
-    # (SSL is unsupported by Python's simple web server), and to replace the
-    # domain and root of the URL with the localhost:<port> value so the data
-    # is served locally instead of from the remote server.
-    ctx.obj.board_index.transform_urls([
-        ('https://', 'http://'),  # Replace https:// with http://
-        (url_transform, 'localhost:{0}'.format(port))  # Replace remote server URL with local test server.
-    ])
-    # Write out the test board index JSON.
-    with open(test_index, 'w') as bi:
-        bi.write(ctx.obj.board_index.write_json())
+    # Serve files from inside the directory with the index file.
+    index_dir = os.path.dirname(os.path.abspath(ctx.obj.board_index_file))
+    def build_test_index():
+        # Transform all package url values in the index to use http instead of
+        # https (SSL is unsupported by Python's simple web server), and to
+        # replace the domain and root of the URL with the localhost:<port> value
+        # so the data is served locally instead of from the remote server.
+        board_index = ctx.obj.read_board_index()
+        board_index.transform_urls([
+            ('https://', 'http://'),  # Replace https:// with http://
+            (url_transform, 'localhost:{0}'.format(port))  # Replace remote server URL with local test server.
+        ])
+        return board_index.write_json().encode('utf-8')
+    # Serve the test board index JSON from memory.  It's only rebuilt when the
+    # source index file changes, and nothing is written to disk so several
+    # test servers can run side by side on different ports.
+    from bpt_server import BoardIndexServer
+    server = BoardIndexServer(('', port), index_dir)
+    server.add_source_memory_file('/' + test_index, ctx.obj.board_index_file,
+        build_test_index, 'application/json')
+    # Build the test index up front so errors are reported before serving.
+    server.get_memory_file('/' + test_index)
     try:
-        server = socketserver.TCPServer(('', port), http.server.SimpleHTTPRequestHandler)
         click.echo('Source board index file: {0}'.format(ctx.obj.board_index_file))
         click.echo('Test server listening at: http://localhost:{0}'.format(port))
         click.echo('Configure Arduino to use the following board package URL:')
         click.echo('  http://localhost:{0}/{1}'.format(port, test_index))
         server.serve_forever()
     finally:
-        # Cleanup the test index file that was created.
-        os.remove(test_index)
+        server.server_close()
+
+
+@bpt_command.command()
+@click.option('--url', '-u', default='http://localhost:8000/package_test_index.json',
+              help='URL to request from the server being benchmarked.  Default is the test index of a test_server on port 8000.')
+@click.option('--clients', '-n', type=click.IntRange(min=1), default=8,
+              help='Number of concurrent clients.  Default is 8.')
+@click.option('--requests', '-r', type=click.IntRange(min=1), default=100,
+              help='Number of requests each client makes over its keep-alive connection.  Default is 100.')
+def benchmark_server(url, clients, requests):
+    """Measure test server throughput with concurrent clients.
+
+    Start a test_server in another terminal and run this command to hammer it
+    with several concurrent clients, then report the request rate, transfer
+    rate and request latencies.
+    """
+    from bpt_server import run_load_benchmark
+    click.echo('Benchmarking {0} with {1} clients making {2} requests each...'.format(url, clients, requests))
+    results = run_load_benchmark(url, clients, requests)
+    latencies = results['latencies']
+    percentile = lambda x: latencies[min(int(len(latencies)*x), len(latencies) - 1)]*1000
+    click.echo('Requests:    {0} ({1} failed)'.format(results['requests'], results['failed']))
+    click.echo('Elapsed:     {0:.2f}s'.format(results['elapsed']))
+    click.echo('Throughput:  {0:.1f} requests/s, {1:.2f} MB/s'.format(
+        results['requests']/results['elapsed'],
+        results['bytes']/results['elapsed']/(1024*1024)))
+    click.echo('Latency:     {0:.1f}ms median, {1:.1f}ms 95th percentile, {2:.1f}ms max'.format(
+        percentile(0.5), percentile(0.95), latencies[-1]*1000))
+
+
+@bpt_command.command()
+@click.option('--url-prefix', '-u', multiple=True,
+              default=['https://adafruit.github.io/arduino-board-index', 'http://adafruit.github.io/arduino-board-index'],
+              help='URL domain and starting path of archives that are published from the board index directory.  Archives with other URLs are hosted elsewhere and skipped.  Can be specified more than once.')
+@click.option('--hash-jobs', type=click.IntRange(min=0), default=0,
+              help='Number of processes to hash archives with.  Default is 0 which uses one per CPU core.')
+@click.option('--cache', 'cache_file', type=click.Path(dir_okay=False, writable=True),
+              help="Specify the JSON file that caches archive hashes by path, modification time and size.  Default is '.bpt_verify_cache.json' in the board index directory.")
+@click.option('--no-cache', is_flag=True,
+              help='Hash every archive again without reading or writing the cache.')
+@click.option('--ignore-missing', is_flag=True,
+              help="Don't report archives that have no local file, only ones that don't match.")
+@click.pass_context
+def verify(ctx, url_prefix, hash_jobs, cache_file, no_cache, ignore_missing):
+    """Verify archives in the board index match local files.
+
+    Check the checksum and size of every platform and tool archive in the board
+    index that is published from the board index directory (like the boards
+    subdirectory) against the local file.  Lists every archive that is missing
+    or doesn't match and exits with an error if there are any.
+    """
+    board_index = ctx.obj.read_board_index(streaming=True)
+    index_dir = os.path.dirname(os.path.abspath(ctx.obj.board_index_file))
+    # Find the local file for every archive published from the index directory.
+    archives = []
+    for package, name, version, entry in board_index.get_downloads():
+        url = entry['url']
+        for prefix in url_prefix:
+            prefix = prefix.rstrip('/') + '/'
+            if url.lower().startswith(prefix.lower()):
+                path = os.path.join(index_dir, *url[len(prefix):].split('/'))
+                archives.append(('{0} {1} {2}'.format(package, name, version), path, entry))
+                break
+    click.echo('Verifying {0} archives published from {1}...'.format(len(archives), index_dir))
+    # Hash all the archives that aren't in the cache across a process pool.
+    cache = None
+    if not no_cache:
+        if cache_file is None:
+            cache_file = os.path.join(index_dir, '.bpt_verify_cache.json')
+        cache = FileHashCache(cache_file)
+    hashes = {}
+    stats = {}
+    for description, path, entry in archives:
+        if path in stats or not os.path.isfile(path):
+            continue
+        stats[path] = os.stat(path)
+        if cache is not None:
+            cached = cache.get(path, stats[path])
+            if cached is not None:
+                hashes[path] = cached
+    to_hash = [x for x in stats if x not in hashes]
+    if hash_jobs == 0:
+        hash_jobs = os.cpu_count() or 1
+    if len(to_hash) > 0:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=hash_jobs) as executor:
+            for path, result in zip(to_hash, executor.map(hash_file, to_hash)):
+                hashes[path] = result
+                if cache is not None:
+                    cache.put(path, stats[path], result)
+    if cache is not None:
+        cache.save(keep=stats.keys())
+    click.echo('Hashed {0} archives, {1} unchanged archives were cached.'.format(len(to_hash),
+        len(stats) - len(to_hash)))
+    # Compare the hashes with the index.
+    problems = 0
+    for description, path, entry in archives:
+        errors = []
+        if path not in hashes:
+            if ignore_missing:
+                continue
+            errors.append('file {0} is missing'.format(path))
+        else:
+            size, sha256 = hashes[path]
+            if str(entry.get('size')) != str(size):
+                errors.append('size is {0} but index has {1}'.format(size, entry.get('size')))
+            checksum = entry.get('checksum', '')
+            if not checksum.upper().startswith('SHA-256:'):
+                errors.append('index checksum {0} is not SHA-256'.format(checksum))
+            elif checksum[len('SHA-256:'):].lower() != sha256:
+                errors.append('SHA-256 is {0} but index has {1}'.format(sha256, checksum[len('SHA-256:'):]))
+        if len(errors) > 0:
+            problems += 1
+            click.echo('- {0} ({1})'.format(description, entry['url']))
+            for error in errors:
+                click.echo('    {0}'.format(error))
+    if problems > 0:
+        click.echo('!!!! {0} ARCHIVES DO NOT MATCH THE BOARD INDEX !!!!'.format(problems))
+        ctx.exit(1)
+    click.echo('All archives match the board index.')
+
+
+@bpt_command.command()
+@click.option('--board', '-b',
+              help='Find platforms with a board of this name, or with boards whose name contains this text.  Case insensitive.')
+@click.option('--architecture', '-a',
+              help='Find platforms for a PACKAGE:ARCHITECTURE, like adafruit:samd.  Accepts a fully qualified board name like adafruit:samd:adafruit_feather_m4 too, but board IDs aren\'t in the index so every board of the architecture matches.')
+@click.option('--tool', '-t',
+              help='Find platforms that depend on a tool given as NAME, PACKAGER:NAME or PACKAGER:NAME@VERSION.')
+@click.option('--latest', is_flag=True,
+              help='Only list the most recent matching version of each platform.')
+@click.option('--json', 'json_output', is_flag=True,
+              help='Print the matching platforms as a JSON list.')
+@click.option('--cache', 'cache_file', type=click.Path(dir_okay=False, writable=True),
+              help="Specify the file that keeps the query index.  Default is the board index file name with a '.query.json' extension.")
+@click.pass_context
+def query(ctx, board, architecture, tool, latest, json_output, cache_file):
+    """Search the board index for platforms.
+
+    Lists the platform versions in the board index that match all of the
+    specified board, architecture and tool queries.  The first query builds an
+    index of the board index that's kept next to it, so later queries don't
+    need to read the whole board index.
+    """
+    if board is None and architecture is None and tool is None:
+        raise click.UsageError('Specify at least one of --board, --architecture or --tool.')
+    if cache_file is None:
+        cache_file = os.path.splitext(ctx.obj.board_index_file)[0] + '.query.json'
+    query_index = BoardQueryIndex.load(ctx.obj.board_index_file, cache_file,
+        json_backend=ctx.obj.json_backend)
+    # Run each query and keep the platforms that match all of them, merging
+    # the extra fields each query adds.
+    results = None
+    queries = []
+    if board is not None:
+        queries.append(query_index.find_boards(board))
+    if architecture is not None:
+        parts = architecture.split(':')
+        if len(parts) < 2:
+            raise click.BadParameter('Expected PACKAGE:ARCHITECTURE.', param_hint='--architecture')
+        queries.append(query_index.find_architecture(parts[0], parts[1]))
+    if tool is not None:
+        version = None
+        if '@' in tool:
+            tool, version = tool.split('@', 1)
+        packager, _, name = tool.rpartition(':')
+        queries.append(query_index.find_tool(name, packager or None, version))
+    for platforms in queries:
+        matches = collections.OrderedDict(((x['package'], x['name'], x['version']), x) for x in platforms)
+        if results is None:
+            results = matches
+            continue
+        for key in list(results.keys()):
+            if key in matches:
+                results[key].update(matches[key])
+            else:
+                del results[key]
+    results = list(results.values())
+    if latest:
+        # Platforms are sorted oldest to newest so keep the last of each.
+        newest = collections.OrderedDict()
+        for platform in results:
+            newest[(platform['package'], platform['name'])] = platform
+        results = list(newest.values())
+    if json_output:
+        click.echo(json.dumps(results, indent=2))
+        return
+    if len(results) == 0:
+        click.echo('No platforms found.')
+        return
+    for platform in results:
+        click.echo('{0} {1} {2} ({0}:{3})'.format(platform['package'], platform['name'],
+            platform['version'], platform['architecture']))
+        click.echo('    {0}'.format(platform['url']))
+        click.echo('    {0} {1} bytes'.format(platform['checksum'], platform['size']))
+        for name in platform.get('boards', []):
+            click.echo('    board: {0}'.format(name))
+        for name in platform.get('tools', []):
+            click.echo('    tool: {0}'.format(name))
+
+
+@bpt_command.command()
+@click.option('--extra-index', '-e', multiple=True, type=click.Path(exists=True, dir_okay=False),
+              help="Specify another board index JSON file whose tools platforms can depend on, like Arduino's package_index.json.  Can be specified more than once.")
+@click.option('--host', 'hosts', multiple=True, type=click.Choice(list(ToolResolver.HOST_PATTERNS.keys())),
+              help='Only resolve tools for this host.  Can be specified more than once.  Default is every host.')
+@click.option('--all-versions', is_flag=True,
+              help='Check every version of each platform instead of only the most recent.')
+@click.option('--json', 'json_output', is_flag=True,
+              help='Print the download sets and dangling dependencies as JSON.')
+@click.option('--strict', is_flag=True,
+              help='Exit with an error if any dependency is dangling.')
+@click.pass_context
+def check_tools(ctx, extra_index, hosts, all_versions, json_output, strict):
+    """Check the tools platforms depend on.
+
+    Resolves the tool dependencies of the platforms in the board index for each
+    host an Arduino client runs on, and reports the total size of the archives
+    a client downloads to install each platform.  Dependencies on tool versions
+    that aren't in the board index (or any extra index), or that have no
+    archive for a host, are reported as dangling.
+    """
+    board_index = ctx.obj.read_board_index()
+    indices = [{'packages': list(board_index.get_packages())}]
+    for path in extra_index:
+        with open(path, 'rb') as index_file:
+            indices.append(ctx.obj.json_backend.loads(index_file.read()))
+    resolver = ToolResolver(indices)
+    hosts = list(hosts) or resolver.get_hosts()
+    def archive_size(entry):
+        try:
+            return int(entry.get('size') or 0)
+        except ValueError:
+            return 0
+    results = []
+    dangling = collections.OrderedDict()
+    for package in board_index.get_packages():
+        names = list(collections.OrderedDict.fromkeys(x.get('name') for x in package.get('platforms', [])))
+        for name in names:
+            platforms = board_index.get_platforms(package['name'], name)
+            if not all_versions:
+                platforms = platforms[-1:]
+            for platform in platforms:
+                result = collections.OrderedDict([('package', package['name']), ('name', name),
+                    ('version', platform.get('version')), ('hosts', collections.OrderedDict())])
+                for host in hosts:
+                    systems, missing = resolver.resolve(platform, host)
+                    result['hosts'][host] = collections.OrderedDict([
+                        ('archives', 1 + len(systems)),
+                        ('size', archive_size(platform) + sum(archive_size(x[1]) for x in systems)),
+                        ('dangling', ['{0}:{1}@{2}'.format(*x[0]) for x in missing])
+                    ])
+                    for tool, reason in missing:
+                        dangling.setdefault((tool, reason), collections.OrderedDict())[
+                            '{0} {1} {2}'.format(package['name'], name, platform.get('version'))] = host
+                results.append(result)
+    if json_output:
+        click.echo(json.dumps({
+            'platforms': results,
+            'dangling': [collections.OrderedDict([('tool', '{0}:{1}@{2}'.format(*tool)),
+                ('reason', reason), ('platforms', list(platforms.keys()))])
+                for (tool, reason), platforms in dangling.items()]
+        }, indent=2))
+    else:
+        for result in results:
+            click.echo('{0} {1} {2}'.format(result['package'], result['name'], result['version']))
+            for host, totals in result['hosts'].items():
+                click.echo('    {0:<20} {1:>3} archives {2:>10.1f} MB{3}'.format(host, totals['archives'],
+                    totals['size']/(1024*1024), ' (incomplete)' if totals['dangling'] else ''))
+        if len(dangling) > 0:
+            click.echo('Dangling tool dependencies:')
+            for (tool, reason), platforms in dangling.items():
+                click.echo('- {0}:{1}@{2}: {3}'.format(tool[0], tool[1], tool[2], reason))
+                click.echo('    needed by {0}'.format(', '.join(platforms.keys())))
+    if strict and len(dangling) > 0:
+        ctx.exit(1)
+
+
+@bpt_command.command()
+@click.option('--keep', '-k', type=click.IntRange(min=1),
+              help='Keep only this many of the most recent versions of each platform.')
+@click.option('--min-version', '-v',
+              help='Keep only platform versions at least this recent.  The most recent version of each platform is always kept.')
+@click.option('--prune-tools', is_flag=True,
+              help='Remove tools that no kept platform depends on.  Other packages might still depend on them!')
+@click.option('--split', is_flag=True,
+              help='Also write an index for each architecture with only its platforms and the tools they depend on.')
+@click.option('--output-dir', '-od', default='.', type=click.Path(file_okay=False),
+              help='Specify the directory to write the indices to.  Default is the current directory.')
+@click.option('--compress/--no-compress', default=True,
+              help='Write gzip and bzip2 compressed copies of each index next to it.  On by default.')
+@click.pass_context
+def prune_index(ctx, keep, min_version, prune_tools, split, output_dir, compress):
+    """Write smaller copies of the board index.
+
+    Writes a slim index with only the most recent platform versions, named like
+    the board index with a _slim suffix (package_adafruit_slim_index.json), and
+    optionally an index for each architecture (package_adafruit_samd_index.json)
+    that clients of one architecture can use instead.  The size of each index
+    and how many bytes it saves compared to the whole board index is reported.
+    """
+    board_index = ctx.obj.read_board_index()
+    name = os.path.basename(ctx.obj.board_index_file)
+    prefix = name[:-len('_index.json')] if name.endswith('_index.json') else os.path.splitext(name)[0]
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    variants = [(os.path.join(output_dir, '{0}_slim_index.json'.format(prefix)),
+        board_index.prune(keep=keep, min_version=min_version, prune_tools=prune_tools))]
+    if split:
+        architectures = sorted(set(x.get('architecture') for package in board_index.get_packages()
+            for x in package.get('platforms', [])))
+        for architecture in architectures:
+            variants.append((os.path.join(output_dir, '{0}_{1}_index.json'.format(prefix, architecture)),
+                board_index.prune(keep=keep, min_version=min_version, architecture=architecture)))
+    # Measure the whole index the same way so the savings compare like with like.
+    with open(ctx.obj.board_index_file, 'rb') as bi:
+        original = bi.read()
+    original_sizes = {'': len(original)}
+    if compress:
+        original_sizes['.gz'] = len(gzip.compress(original, 9, mtime=0))
+        original_sizes['.bz2'] = len(bz2.compress(original, 9))
+    click.echo('{0:<50} {1:>12} {2:>12} {3:>7}'.format('Index', 'Bytes', 'Saved', 'Saved %'))
+    click.echo('{0:<50} {1:>12}'.format(ctx.obj.board_index_file, original_sizes['']))
+    for path, pruned in variants:
+        pruned.write_file(path)
+        paths = {'': path}
+        if compress:
+            paths.update(write_compressed_copies(path))
+        for extension in sorted(paths, key=len):
+            size = os.path.getsize(paths[extension])
+            saved = original_sizes[extension] - size
+            click.echo('{0:<50} {1:>12} {2:>12} {3:>6.1f}%'.format(paths[extension], size, saved,
+                100.0*saved/original_sizes[extension]))
+
+
+@bpt_command.command()
+@click.option('--output-dir', '-od', default='mirror', type=click.Path(file_okay=False),
+              help="Specify the directory to mirror archives to, in a subdirectory per host.  Default is 'mirror'.")
+@click.option('--url-prefix', '-u', multiple=True,
+              help='Only mirror archives whose URL starts with this prefix.  Can be specified more than once.  Default is every archive.')
+@click.option('--download-jobs', type=click.IntRange(min=1), default=8,
+              help='Maximum number of archives to download at the same time.  Default is 8.')
+@click.option('--max-per-host', type=click.IntRange(min=1), default=4,
+              help='Maximum number of connections to one host at the same time.  Default is 4.')
+@click.option('--timeout', type=click.FloatRange(min=0, min_open=True), default=60,
+              help='Seconds to wait for a host to respond before retrying.  Default is 60.')
+@click.option('--retries', type=click.IntRange(min=0), default=2,
+              help='Number of times to resume a failed download.  Default is 2.')
+@click.option('--no-cache', is_flag=True,
+              help="Hash every mirrored archive again instead of using the '.bpt_mirror_cache.json' hash cache in the output directory.")
+@click.pass_context
+def mirror(ctx, output_dir, url_prefix, download_jobs, max_per_host, timeout, retries, no_cache):
+    """Download every archive in the board index.
+
+    Mirror every platform and tool archive the board index references, from
+    any host, into a local directory for offline use.  Archives already in the
+    mirror that match the index are skipped, interrupted downloads are resumed
+    and every download is checked against the index checksum and size before
+    it's moved into place.  Exits with an error if any archive fails.
+    """
+    from bpt_mirror import ArchiveMirror, ConnectionPool
+    board_index = ctx.obj.read_board_index(streaming=True)
+    # Find each archive URL once, tools are often shared between packages.
+    archives = collections.OrderedDict()
+    conflicts = set()
+    for package, name, version, entry in board_index.get_downloads():
+        url = entry['url']
+        if len(url_prefix) > 0 and not any(url.lower().startswith(x.lower()) for x in url_prefix):
+            continue
+        download = (entry.get('checksum'), entry.get('size'))
+        if url in archives and archives[url][1] != download:
+            conflicts.add(url)
+        archives.setdefault(url, ('{0} {1} {2}'.format(package, name, version), download))
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    cache = None
+    if not no_cache:
+        cache = FileHashCache(os.path.join(output_dir, '.bpt_mirror_cache.json'))
+    pool = ConnectionPool(max_per_host=max_per_host, timeout=timeout)
+    archive_mirror = ArchiveMirror(output_dir, pool, hash_cache=cache, retries=retries)
+    click.echo('Mirroring {0} archives to {1}...'.format(len(archives), output_dir))
+    paths = {}
+    def fetch(url):
+        description, (checksum, size) = archives[url]
+        paths[url] = archive_mirror.get_path(url)
+        if url in conflicts:
+            raise RuntimeError('Index has different checksums or sizes for the same URL!')
+        if archive_mirror.is_valid(url, size, checksum):
+            return None
+        return archive_mirror.download(url, size, checksum)
+    counts = collections.Counter()
+    start = time.perf_counter()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=download_jobs) as executor:
+            futures = dict((executor.submit(fetch, x), x) for x in archives)
+            for future in concurrent.futures.as_completed(futures):
+                url = futures[future]
+                try:
+                    result = future.result()
+                except (OSError, RuntimeError) as ex:
+                    counts['failed'] += 1
+                    click.echo('- FAILED {0} ({1})'.format(archives[url][0], url))
+                    click.echo('    {0}'.format(ex))
+                    continue
+                if result is None:
+                    counts['skipped'] += 1
+                    continue
+                downloaded, resumed = result
+                counts['downloaded'] += 1
+                counts['bytes'] += downloaded
+                if resumed > 0:
+                    counts['resumed'] += 1
+                click.echo('- {0} {1} ({2} bytes{3})'.format('Resumed' if resumed > 0 else 'Downloaded',
+                    archives[url][0], downloaded, ', kept {0} bytes'.format(resumed) if resumed > 0 else ''))
+    finally:
+        pool.close()
+        if cache is not None:
+            cache.save(keep=paths.values())
+    elapsed = time.perf_counter() - start
+    click.echo('Downloaded {0} archives ({1} resumed), {2} bytes in {3:.1f}s ({4:.2f} MB/s).'.format(
+        counts['downloaded'], counts['resumed'], counts['bytes'], elapsed,
+        counts['bytes']/max(elapsed, 1e-6)/(1024*1024)))
+    click.echo('{0} archives were already mirrored.'.format(counts['skipped']))
+    if counts['failed'] > 0:
+        click.echo('!!!! {0} ARCHIVES FAILED TO MIRROR !!!!'.format(counts['failed']))
+        ctx.exit(1)
 
 
 if __name__ == '__main__':
@@ -256,6 +868,5 @@ if __name__ == '__main__':
     finally:
         # Close any board packages that were opened, this will clean up temporary
         # file locations, etc.
-        if context.board_packages is not None:
-            for package in context.board_packages:
-                package.close()
+        if context.board_config is not None:
+            context.board_config.close()
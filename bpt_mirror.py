@@ -0,0 +1,320 @@
+# Adafruit Arduino Board Package Tool (bpt) Archive Mirror
+# Downloads the platform and tool archives referenced by a board index into a
+# local directory over pooled keep-alive HTTP connections, resuming partial
+# downloads and verifying every file against the checksum and size in the index.
+#
+# Copyright (c) 2016 Adafruit Industries
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import contextlib
+import hashlib
+import http.client
+import logging
+import os
+import re
+import threading
+import urllib.parse
+
+from bpt_model import hash_file
+
+
+logger = logging.getLogger(__name__)
+
+
+# Hashlib algorithm names of the checksum prefixes used in board indices.
+CHECKSUM_ALGORITHMS = {'SHA-256': 'sha256', 'SHA-1': 'sha1', 'MD5': 'md5'}
+
+
+def parse_checksum(checksum):
+    """Parse a board index checksum like 'SHA-256:<hex digest>' and return a
+    tuple of the hashlib algorithm name and lowercase hex digest.
+    """
+    prefix, _, digest = (checksum or '').partition(':')
+    algorithm = CHECKSUM_ALGORITHMS.get(prefix.strip().upper())
+    if algorithm is None or digest == '':
+        raise RuntimeError('Unsupported archive checksum {0}!'.format(checksum))
+    return (algorithm, digest.strip().lower())
+
+
+def mirror_path(output_dir, url):
+    """Return the path of the file inside output_dir that mirrors the archive
+    at url, which is the URL host followed by the URL path.
+    """
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise RuntimeError('Archive URL {0} is not an HTTP or HTTPS URL!'.format(url))
+    host = parts.hostname if parts.port is None else '{0}_{1}'.format(parts.hostname, parts.port)
+    segments = [urllib.parse.unquote(x) for x in parts.path.split('/') if x not in ('', '.')]
+    if len(segments) == 0 or any(x == '..' or '/' in x or os.sep in x for x in segments):
+        raise RuntimeError('Archive URL {0} has no file name or an unsafe path!'.format(url))
+    return os.path.join(output_dir, host, *segments)
+
+
+class ConnectionPool(object):
+    """Pool of keep-alive HTTP and HTTPS connections shared between threads.
+    Connections are kept per server and reused by the next request to the same
+    server, and at most max_per_host connections to one server are in use at
+    once so a mirror run doesn't overload any host.
+    """
+
+    # Maximum number of redirects to follow for one request.
+    MAX_REDIRECTS = 5
+
+    def __init__(self, max_per_host=4, timeout=60):
+        """Initialize pool with the specified maximum number of connections in
+        use per server and socket timeout in seconds.
+        """
+        self._max_per_host = max_per_host
+        self._timeout = timeout
+        self._idle = {}
+        self._limits = {}
+        self._lock = threading.Lock()
+
+    def _checkout(self, key):
+        """Return a tuple of an idle or new connection to the server with the
+        specified (scheme, host, port) key and True if it was idle.
+        """
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) > 0:
+                return (idle.pop(), True)
+        scheme, host, port = key
+        connection_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        logger.debug('ConnectionPool opening connection to {0}://{1}:{2}'.format(scheme, host, port))
+        return (connection_class(host, port, timeout=self._timeout), False)
+
+    def _send(self, key, path, headers):
+        """Send a GET request for path to the server with the specified key
+        and return a tuple of the connection and response.  Waits until fewer
+        than max_per_host connections to the server are in use.  A request on
+        an idle connection the server already closed is sent again on another.
+        """
+        with self._lock:
+            limit = self._limits.setdefault(key, threading.BoundedSemaphore(self._max_per_host))
+        limit.acquire()
+        try:
+            while True:
+                connection, reused = self._checkout(key)
+                try:
+                    connection.request('GET', path, headers=headers)
+                    return (connection, connection.getresponse())
+                except (ConnectionError, http.client.BadStatusLine):
+                    connection.close()
+                    if not reused:
+                        raise
+                    logger.debug('ConnectionPool retrying request on closed keep-alive connection')
+                except Exception:
+                    connection.close()
+                    raise
+        except Exception:
+            limit.release()
+            raise
+
+    def _finish(self, key, connection, response):
+        """Return the connection of a finished response to the pool if its
+        body was read completely and the server keeps it alive, otherwise close
+        it.
+        """
+        if response.isclosed() and not response.will_close:
+            with self._lock:
+                self._idle[key].append(connection)
+        else:
+            connection.close()
+        self._limits[key].release()
+
+    @contextlib.contextmanager
+    def open(self, url, headers=None):
+        """Context manager that sends a GET request for url with the specified
+        dict of headers, following redirects, and returns the response.  The
+        connection is returned to the pool on exit if the body was read.
+        """
+        for i in range(self.MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            key = (parts.scheme, parts.hostname, parts.port)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            connection, response = self._send(key, path, headers or {})
+            location = response.getheader('Location')
+            if response.status not in (301, 302, 303, 307, 308) or location is None:
+                break
+            response.read()
+            self._finish(key, connection, response)
+            url = urllib.parse.urljoin(url, location)
+            logger.debug('ConnectionPool following redirect to {0}'.format(url))
+        else:
+            raise RuntimeError('Too many redirects requesting {0}!'.format(url))
+        try:
+            yield response
+        finally:
+            self._finish(key, connection, response)
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            for idle in self._idle.values():
+                for connection in idle:
+                    connection.close()
+                del idle[:]
+
+
+class ArchiveMirror(object):
+    """Mirror of archives in a local directory.  Archives are downloaded to a
+    .part file next to their mirror path and only moved into place once their
+    size and checksum match the board index, so an interrupted download is
+    resumed with an HTTP range request on the next attempt or run.
+    """
+
+    # Number of bytes to read from a response at a time.
+    CHUNK_SIZE = 256*1024
+
+    def __init__(self, output_dir, pool, hash_cache=None, retries=2):
+        """Initialize mirror of archives in output_dir downloaded with the
+        specified ConnectionPool.  If a FileHashCache is specified as
+        hash_cache archives already in the mirror are only hashed again when
+        they change.  Failed downloads are resumed up to retries times.
+        """
+        self._output_dir = output_dir
+        self._pool = pool
+        self._hash_cache = hash_cache
+        self._retries = retries
+
+    def get_path(self, url):
+        """Return the path the archive at url is mirrored to."""
+        return mirror_path(self._output_dir, url)
+
+    def is_valid(self, url, size, checksum):
+        """Return True if the mirrored archive at url exists and matches the
+        specified size (or None to not check it) and checksum.
+        """
+        path = self.get_path(url)
+        if not os.path.isfile(path):
+            return False
+        stat = os.stat(path)
+        if size is not None and stat.st_size != int(size):
+            return False
+        algorithm, digest = parse_checksum(checksum)
+        result = None
+        if self._hash_cache is not None:
+            result = self._hash_cache.get(path, stat)
+        if result is None or result[1] != digest:
+            result = hash_file(path, algorithm)
+            if self._hash_cache is not None:
+                self._hash_cache.put(path, stat, result)
+        return result[1] == digest
+
+    def download(self, url, size, checksum):
+        """Download the archive at url into the mirror and verify it has the
+        specified size (or None to not check it) and checksum while it's
+        streamed.  A partial download left by an earlier attempt is resumed.
+        Returns a tuple of the number of bytes downloaded and the number of
+        bytes of a partial download that were kept.  Raises RuntimeError if the
+        archive can't be downloaded or doesn't match the index.
+        """
+        algorithm, digest = parse_checksum(checksum)
+        size = int(size) if size is not None else None
+        path = self.get_path(url)
+        part = path + '.part'
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        downloaded = 0
+        error = None
+        for attempt in range(self._retries + 1):
+            try:
+                offset, hasher = self._read_part(part, algorithm, size)
+                received, hasher = self._fetch(url, part, offset, hasher, size)
+            except (OSError, http.client.HTTPException) as ex:
+                # Keep what was received so the next attempt resumes from it.
+                logger.debug('Download of {0} failed: {1}'.format(url, ex))
+                error = ex
+                continue
+            downloaded += received
+            total = os.path.getsize(part)
+            if (size is None or total == size) and hasher.hexdigest() == digest:
+                os.replace(part, path)
+                if self._hash_cache is not None:
+                    self._hash_cache.put(path, os.stat(path), (total, digest))
+                return (downloaded, total - received)
+            os.remove(part)
+            if received == total:
+                # The whole archive was downloaded in this attempt, so it's the
+                # index or the host that is wrong and retrying won't help.
+                raise RuntimeError('Downloaded {0} bytes with {1} {2} but index has {3} bytes with {1} {4}!'.format(
+                    total, algorithm, hasher.hexdigest(), size, digest))
+            # Otherwise the partial download was stale, start over.
+            error = RuntimeError('resumed download did not match the index')
+        raise RuntimeError('Failed to download {0}: {1}'.format(url, error))
+
+    def _read_part(self, part, algorithm, size):
+        """Return a tuple of the size of the partial download at path part and
+        a hasher of the algorithm updated with its contents.  A partial download
+        that is already as large as the archive is removed.
+        """
+        hasher = hashlib.new(algorithm)
+        if not os.path.exists(part):
+            return (0, hasher)
+        if size is not None and os.path.getsize(part) >= size:
+            os.remove(part)
+            return (0, hasher)
+        offset = 0
+        with open(part, 'rb') as source:
+            for chunk in iter(lambda: source.read(1024*1024), b''):
+                hasher.update(chunk)
+                offset += len(chunk)
+        return (offset, hasher)
+
+    def _fetch(self, url, part, offset, hasher, size):
+        """Request the archive at url starting at byte offset and append it to
+        the partial download at path part, updating hasher.  Returns a tuple of
+        the number of bytes received and the hasher, which is new if the server
+        sent the whole archive instead of the requested range.
+        """
+        headers = {}
+        if offset > 0:
+            headers['Range'] = 'bytes={0}-'.format(offset)
+        with self._pool.open(url, headers) as response:
+            content_range = re.match(r'bytes\s+(\d+)-', response.getheader('Content-Range', ''))
+            if response.status == 206 and content_range is not None and int(content_range.group(1)) == offset:
+                mode = 'ab'
+            elif response.status == 200:
+                offset = 0
+                hasher = hashlib.new(hasher.name)
+                mode = 'wb'
+            else:
+                response.read()
+                if response.status == 416:
+                    # The partial download is stale, start over next attempt.
+                    os.remove(part)
+                elif response.status < 500:
+                    raise RuntimeError('HTTP {0} {1} requesting {2}!'.format(response.status,
+                        response.reason, url))
+                # Retry server errors and ranges that can't be satisfied.
+                raise http.client.HTTPException('HTTP {0} {1}'.format(response.status, response.reason))
+            received = 0
+            too_large = False
+            with open(part, mode) as target:
+                for chunk in iter(lambda: response.read(self.CHUNK_SIZE), b''):
+                    if size is not None and offset + received + len(chunk) > size:
+                        too_large = True
+                        break
+                    hasher.update(chunk)
+                    target.write(chunk)
+                    received += len(chunk)
+        if too_large:
+            os.remove(part)
+            raise RuntimeError('Server sent more than the {0} bytes in the index for {1}!'.format(size, url))
+        return (received, hasher)
@@ -21,7 +21,14 @@
 # COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
 # IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import bisect
+import bz2
+import collections
+import concurrent.futures
 import configparser
+import contextlib
+import functools
+import gzip
 import hashlib
 import json
 import logging
@@ -30,15 +37,560 @@ import os.path
 import posixpath
 import re
 import shutil
+import sys
 import tarfile
 import tempfile
+import threading
+import time
 
-from git import Repo
-from pkg_resources import parse_version
+# GitPython is only imported by the code that works with Git repositories, as
+# importing it is slow and commands that don't touch Git shouldn't pay for it.
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 
 logger = logging.getLogger(__name__)
 
+# Modification time (1980-01-01 00:00:00 UTC) given to every entry of a
+# deterministic archive.
+DETERMINISTIC_MTIME = 315532800
+
+# Profiler that records phases, see set_profiler.
+_profiler = None
+
+
+def _peak_rss():
+    """Return the peak resident memory of this process in bytes, or None if it
+    can't be measured on this platform.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and macOS bytes.
+    return peak if sys.platform == 'darwin' else peak*1024
+
+
+class PhaseProfiler(object):
+    """Records the wall clock time and peak memory of named phases of work,
+    like cloning a repository or writing an archive.  Phases can run in
+    parallel threads.  Peak memory is the peak resident memory of the whole
+    process, so a phase's growth includes anything running at the same time.
+    """
+
+    def __init__(self):
+        self._start = time.perf_counter()
+        self._phases = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name, detail=None):
+        """Context manager that records the code inside it as a phase with the
+        specified name and optional detail (like the package it's for).
+        """
+        start = time.perf_counter()
+        peak = _peak_rss()
+        try:
+            yield
+        finally:
+            self.add_phase(name, detail, start, time.perf_counter() - start, peak)
+
+    def add_phase(self, name, detail, start, elapsed, peak_before=None):
+        """Record a phase that started at the specified time.perf_counter value
+        and took elapsed seconds.  Used for work that's timed in pieces, like
+        hashing data as it's written.
+        """
+        peak = _peak_rss()
+        growth = None
+        if peak is not None and peak_before is not None:
+            growth = peak - peak_before
+        with self._lock:
+            self._phases.append({
+                'name': name,
+                'detail': detail,
+                'thread': threading.get_ident(),
+                'start': start - self._start,
+                'elapsed': elapsed,
+                'peak_rss': peak,
+                'peak_growth': growth
+            })
+
+    def get_phases(self):
+        """Return a list of dicts describing every recorded phase."""
+        with self._lock:
+            return list(self._phases)
+
+    def get_summary(self):
+        """Return a list of dicts that total the phases of each name, in the
+        order the names were first recorded.
+        """
+        summary = collections.OrderedDict()
+        for phase in self.get_phases():
+            totals = summary.setdefault(phase['name'], {'name': phase['name'], 'count': 0,
+                'total': 0.0, 'max': 0.0, 'peak_rss': None, 'peak_growth': None})
+            totals['count'] += 1
+            totals['total'] += phase['elapsed']
+            totals['max'] = max(totals['max'], phase['elapsed'])
+            for field in ('peak_rss', 'peak_growth'):
+                if phase[field] is not None:
+                    totals[field] = max(totals[field] or 0, phase[field])
+        return list(summary.values())
+
+    def write_chrome_trace(self, path):
+        """Write the phases to a JSON file in the Chrome trace event format,
+        which can be viewed in chrome://tracing or Perfetto.
+        """
+        events = []
+        for phase in self.get_phases():
+            events.append({
+                'name': phase['name'] if phase['detail'] is None else '{0} {1}'.format(phase['name'], phase['detail']),
+                'cat': phase['name'],
+                'ph': 'X',
+                'ts': int(phase['start']*1000000),
+                'dur': int(phase['elapsed']*1000000),
+                'pid': os.getpid(),
+                'tid': phase['thread'],
+                'args': {'peak_rss': phase['peak_rss'], 'peak_growth': phase['peak_growth']}
+            })
+        with open(path, 'w') as trace:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace, indent=2)
+
+
+def set_profiler(profiler):
+    """Set the PhaseProfiler that records the phases of work done by this
+    module, or None to stop recording.
+    """
+    global _profiler
+    _profiler = profiler
+
+
+def profile_phase(name, detail=None):
+    """Return a context manager that records the code inside it as a phase in
+    the current profiler, or does nothing if there is no profiler.
+    """
+    if _profiler is None:
+        return contextlib.nullcontext()
+    return _profiler.phase(name, detail)
+
+
+@functools.total_ordering
+class Version(object):
+    """Parsed version of a platform, ordered the way Arduino clients and
+    pkg_resources order versions: numeric release parts compare as numbers,
+    trailing zeros are ignored (1.0 equals 1.0.0), pre-releases (1.0.0-rc1,
+    1.0.0b2) and development releases (1.0.dev1) come before their release,
+    post releases (1.0.post1 or 1.0-1) after it, and versions with a higher
+    epoch (1!0.1) after all versions with a lower one, following PEP 440 like
+    packaging.version.Version.  Strings that aren't versions at all
+    sort before every real version.  The sort key is computed once when
+    parsing so comparisons are just tuple comparisons.
+    """
+
+    __slots__ = ('_version', '_key')
+
+    _PATTERN = re.compile(r"""
+        v?(?:(?P<epoch>\d+)!)?(?P<release>\d+(?:\.\d+)*)
+        (?:[-_.]?(?P<pre>a|alpha|b|beta|c|rc|pre|preview)[-_.]?(?P<pre_number>\d*))?
+        (?:-(?P<implicit_post>\d+)|[-_.]?(?P<post>post|rev|r)[-_.]?(?P<post_number>\d*))?
+        (?:[-_.]?(?P<dev>dev)[-_.]?(?P<dev_number>\d*))?
+        (?:\+(?P<local>[a-z0-9.]*))?
+        """, re.VERBOSE | re.IGNORECASE)
+
+    _PRE_RANKS = {'a': 0, 'alpha': 0, 'b': 1, 'beta': 1, 'c': 2, 'rc': 2, 'pre': 2, 'preview': 2}
+
+    def __init__(self, version):
+        """Parse the specified version string."""
+        self._version = version
+        match = self._PATTERN.fullmatch(version.strip())
+        if match is None:
+            self._key = (0, version)
+            return
+        release = [int(x) for x in match.group('release').split('.')]
+        while len(release) > 1 and release[-1] == 0:
+            release.pop()
+        number = lambda x: int(match.group(x) or 0)
+        # An implicit post release (1.0-1) is the same as 1.0.post1.
+        is_post = match.group('post') is not None or match.group('implicit_post') is not None
+        if match.group('pre') is not None:
+            pre = (0, self._PRE_RANKS[match.group('pre').lower()], number('pre_number'))
+        elif match.group('dev') is not None and not is_post:
+            # A development release without a pre-release tag comes first.
+            pre = (-1,)
+        else:
+            pre = (1,)
+        post = (number('post_number') + number('implicit_post'),) if is_post else (-1,)
+        dev = (0, number('dev_number')) if match.group('dev') is not None else (1,)
+        # Local versions (1.0+local) come after the plain version, with numeric
+        # parts after alphanumeric ones.
+        local = ()
+        if match.group('local') is not None:
+            local = tuple((1, int(x), '') if x.isdigit() else (0, 0, x.lower())
+                for x in match.group('local').split('.'))
+        self._key = (1, number('epoch'), tuple(release), pre, post, dev, local)
+
+    def __str__(self):
+        return self._version
+
+    def __repr__(self):
+        return 'Version({0!r})'.format(self._version)
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def __eq__(self, other):
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self._key == other._key
+
+    def __lt__(self, other):
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self._key < other._key
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_version(version):
+    """Return the Version parsed from the specified version string.  Parsed
+    versions are cached since the same versions are compared over and over.
+    """
+    return Version(version)
+
+
+def parse_platform_version(platform_txt):
+    """Parse the platform version out of the lines of an Arduino platform.txt
+    file.  Returns the version string or None if no version was found.
+    """
+    version = None
+    for line in platform_txt:
+        # Look for 'version=<platform version>' line and grab the version.
+        # Grab everything up to the end of line or start of comment (#).
+        match = re.match('version=([^#]+)', line, flags=re.IGNORECASE)
+        if match:
+            version = match.group(1).strip()
+    return version
+
+
+def _compress_bz2_block(data):
+    """Compress a block of data into a complete bzip2 stream.  Must be module
+    level so it can be run in a process pool.
+    """
+    return bz2.compress(data, 9)
+
+
+class ParallelBZ2Writer(object):
+    """Write-only file object that bzip2 compresses data across a process pool.
+    The input is split into independent blocks that are each compressed into a
+    complete bzip2 stream, and the streams are written to the underlying file
+    in order.  Concatenated bzip2 streams are a valid bzip2 file (the same
+    output pbzip2 produces) which bzip2, Python's bz2 module and Arduino clients
+    all read back as one file.
+    """
+
+    def __init__(self, fileobj, executor, workers, block_size=900000):
+        """Initialize writer that writes compressed data to fileobj using the
+        specified concurrent.futures executor with the specified number of
+        workers.  Block size is the number of uncompressed bytes in each bzip2
+        stream, by default the same as bzip2's largest (-9) block size.
+        """
+        self._fileobj = fileobj
+        self._executor = executor
+        self._block_size = block_size
+        # Limit the blocks in flight so memory stays bounded when compression
+        # is slower than the data coming in.
+        self._max_pending = workers*2
+        self._pending = collections.deque()
+        self._buffer = bytearray()
+        self._blocks = 0
+
+    def _submit(self, block):
+        """Queue a block to be compressed and write out finished blocks."""
+        self._pending.append(self._executor.submit(_compress_bz2_block, block))
+        self._blocks += 1
+        while len(self._pending) > self._max_pending:
+            self._fileobj.write(self._pending.popleft().result())
+
+    def write(self, data):
+        """Buffer data and compress every full block."""
+        self._buffer.extend(data)
+        while len(self._buffer) >= self._block_size:
+            block = bytes(self._buffer[:self._block_size])
+            del self._buffer[:self._block_size]
+            self._submit(block)
+        return len(data)
+
+    def close(self):
+        """Compress any remaining data and wait for all blocks to be written.
+        Does not close the underlying file.
+        """
+        # Always write at least one stream so empty input is still valid bzip2.
+        if len(self._buffer) > 0 or self._blocks == 0:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        while len(self._pending) > 0:
+            self._fileobj.write(self._pending.popleft().result())
+
+
+class HashingFileWriter(object):
+    """Write-only file object that passes data through to another file while
+    computing its SHA256 hash and size, so written data never has to be read
+    back.
+    """
+
+    def __init__(self, fileobj):
+        """Initialize writer that writes all data to fileobj."""
+        self._fileobj = fileobj
+        self._sha256 = hashlib.sha256()
+        self._size = 0
+        self._hash_time = 0.0
+
+    def write(self, data):
+        """Write data to the underlying file and add it to the hash."""
+        self._fileobj.write(data)
+        start = time.perf_counter()
+        self._sha256.update(data)
+        self._hash_time += time.perf_counter() - start
+        self._size += len(data)
+        return len(data)
+
+    def flush(self):
+        """Flush the underlying file."""
+        self._fileobj.flush()
+
+    def get_size(self):
+        """Return the number of bytes written so far."""
+        return self._size
+
+    def get_sha256(self):
+        """Return the hex SHA256 hash of the bytes written so far."""
+        return self._sha256.hexdigest()
+
+    def get_hash_time(self):
+        """Return the seconds spent hashing the bytes written so far."""
+        return self._hash_time
+
+
+def _normalize_tarinfo(tarinfo):
+    """Tar filter that strips the metadata which varies between machines and
+    checkouts (modification time, owner, umask) from an archive entry.
+    """
+    tarinfo.mtime = DETERMINISTIC_MTIME
+    tarinfo.uid = 0
+    tarinfo.gid = 0
+    tarinfo.uname = ''
+    tarinfo.gname = ''
+    if tarinfo.isdir() or tarinfo.mode & 0o111:
+        tarinfo.mode = 0o755
+    else:
+        tarinfo.mode = 0o644
+    return tarinfo
+
+
+class ArchiveBuildCache(object):
+    """Directory of previously built board package archives, keyed by a hash
+    of everything that determines the archive's bytes.  An unchanged package
+    reuses its cached archive and checksum instead of being compressed again.
+    Only deterministic archives can be cached.
+    """
+
+    def __init__(self, cache_dir):
+        """Initialize build cache that lives in the specified cache_dir
+        directory (it will be created if it doesn't exist).
+        """
+        self._cache_dir = cache_dir
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def get_key(self, *values):
+        """Return the cache key for the specified list of string values."""
+        return hashlib.sha256('\0'.join(values).encode('utf-8')).hexdigest()
+
+    def get(self, key, target):
+        """Copy the cached archive for key to the target file name.  Returns
+        a tuple of (archive size in bytes, archive SHA256 hash), or None if the
+        archive isn't in the cache.
+        """
+        archive_path = os.path.join(self._cache_dir, key + '.tar.bz2')
+        meta_path = os.path.join(self._cache_dir, key + '.json')
+        if not os.path.exists(archive_path) or not os.path.exists(meta_path):
+            return None
+        with open(meta_path, 'r') as meta_file:
+            meta = json.load(meta_file)
+        logger.debug('ArchiveBuildCache copying cached archive {0} to {1}'.format(archive_path, target))
+        shutil.copyfile(archive_path, target)
+        return (meta['size'], meta['sha256'])
+
+    def put(self, key, source, size, sha256):
+        """Add the archive at the source file name with the specified size and
+        SHA256 hash to the cache under key.
+        """
+        archive_path = os.path.join(self._cache_dir, key + '.tar.bz2')
+        meta_path = os.path.join(self._cache_dir, key + '.json')
+        logger.debug('ArchiveBuildCache storing archive {0} as {1}'.format(source, archive_path))
+        # Write both files under temporary names and rename them into place so
+        # a partially written entry is never used.  The metadata goes last as
+        # it marks the entry complete.
+        shutil.copyfile(source, archive_path + '.partial')
+        os.replace(archive_path + '.partial', archive_path)
+        with open(meta_path + '.partial', 'w') as meta_file:
+            json.dump({'size': size, 'sha256': sha256}, meta_file)
+        os.replace(meta_path + '.partial', meta_path)
+
+
+class JSONBackend(object):
+    """JSON serializer used to read and write board index files, built on the
+    standard library json module.  All backends write JSON in the same layout
+    as the published board index (2 space indents, ASCII only).
+    """
+
+    name = 'json'
+
+    def loads(self, data):
+        """Decode the specified JSON bytes or string."""
+        return json.loads(data)
+
+    def dumps(self, data):
+        """Encode the specified data as a JSON string."""
+        return json.dumps(data, indent=2, separators=(',', ': '))
+
+
+class OrjsonBackend(JSONBackend):
+    """JSON serializer built on the much faster orjson package.  Output is
+    byte-for-byte the same as JSONBackend for board index data (strings,
+    integers, booleans, nulls, lists and objects), floats may be formatted
+    differently.
+    """
+
+    name = 'orjson'
+
+    # Characters that the json module escapes but orjson writes as is.  Written
+    # as a negated ASCII class because the equivalent \x7f-\U0010ffff range is
+    # slow to compile, which every bpt command would pay at startup.
+    _UNESCAPED = re.compile('[^\x00-\x7e]')
+
+    @staticmethod
+    def _escape(match):
+        """Return the json module's \\u escape for a matched character,
+        using a surrogate pair for characters outside the basic plane.
+        """
+        code = ord(match.group(0))
+        if code > 0xFFFF:
+            code -= 0x10000
+            return '\\u{0:04x}\\u{1:04x}'.format(0xD800 | (code >> 10), 0xDC00 | (code & 0x3FF))
+        return '\\u{0:04x}'.format(code)
+
+    def loads(self, data):
+        """Decode the specified JSON bytes or string."""
+        return orjson.loads(data)
+
+    def dumps(self, data):
+        """Encode the specified data as a JSON string."""
+        text = orjson.dumps(data, option=orjson.OPT_INDENT_2).decode('utf-8')
+        return self._UNESCAPED.sub(self._escape, text)
+
+
+def get_json_backend(name='auto'):
+    """Return the JSON backend with the specified name, either 'json' or
+    'orjson'.  The default 'auto' picks orjson if it's installed and falls back
+    to the standard library otherwise.
+    """
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'json'
+    if name == 'orjson':
+        if orjson is None:
+            raise RuntimeError('The orjson JSON backend requires the orjson package to be installed!')
+        return OrjsonBackend()
+    elif name == 'json':
+        return JSONBackend()
+    raise RuntimeError('Unknown JSON backend: {0}'.format(name))
+
+
+def hash_file(path, algorithm='sha256'):
+    """Return a tuple of (size in bytes, hex digest) of the file at path hashed
+    with the named hashlib algorithm (SHA256 by default), reading it in chunks
+    so memory use doesn't depend on the file size.
+    """
+    hasher = hashlib.new(algorithm)
+    size = 0
+    with open(path, 'rb') as source:
+        for chunk in iter(lambda: source.read(1024*1024), b''):
+            hasher.update(chunk)
+            size += len(chunk)
+    return (size, hasher.hexdigest())
+
+
+def write_compressed_copies(path):
+    """Write gzip and bzip2 compressed copies of the file at path next to it,
+    with .gz and .bz2 extensions, so web servers can serve them precompressed.
+    The copies don't depend on when they're written.  Returns a dict of the
+    compressed file paths by extension.
+    """
+    with open(path, 'rb') as source:
+        data = source.read()
+    paths = {}
+    for extension, compress in (('.gz', lambda x: gzip.compress(x, 9, mtime=0)),
+                                ('.bz2', lambda x: bz2.compress(x, 9))):
+        paths[extension] = path + extension
+        with open(paths[extension], 'wb') as target:
+            target.write(compress(data))
+    return paths
+
+
+class FileHashCache(object):
+    """Cache of file hashes stored in a JSON file.  A cached hash is only used
+    while the file's path, modification time and size are unchanged.
+    """
+
+    def __init__(self, cache_file):
+        """Initialize cache stored in the specified JSON file path, which will
+        be created when saving if it doesn't exist.
+        """
+        self._cache_file = cache_file
+        self._entries = {}
+        if os.path.exists(cache_file):
+            try:
+                with open(cache_file, 'r') as cache:
+                    self._entries = json.load(cache)
+            except ValueError:
+                logger.debug('Ignoring unreadable hash cache {0}'.format(cache_file))
+
+    @staticmethod
+    def _key(path, stat):
+        """Return the cache key for a file path and its os.stat result."""
+        return '{0}:{1}:{2}'.format(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+    def get(self, path, stat):
+        """Return the cached (size, hash) tuple of the file at path with
+        the specified os.stat result, or None if it isn't cached.
+        """
+        entry = self._entries.get(self._key(path, stat))
+        if entry is None:
+            return None
+        return tuple(entry)
+
+    def put(self, path, stat, result):
+        """Cache the (size, hash) tuple of the file at path with the
+        specified os.stat result.
+        """
+        self._entries[self._key(path, stat)] = list(result)
+
+    def save(self, keep=None):
+        """Write the cache to its JSON file.  If keep is a list of file paths
+        only the entries of those files are saved.
+        """
+        entries = self._entries
+        if keep is not None:
+            keep = set(map(os.path.abspath, keep))
+            entries = dict((k, v) for k, v in entries.items() if k.rsplit(':', 2)[0] in keep)
+        with open(self._cache_file, 'w') as cache:
+            json.dump(entries, cache, indent=2, sort_keys=True)
+
 
 class BoardPackage(object):
     """Board package instance state (name, version, etc.)."""
@@ -104,11 +656,11 @@ class BoardPackage(object):
         """
         pass
 
-    def write_archive(self, target):
+    def write_archive(self, target, jobs=1, deterministic=False, build_cache=None):
         """Create an archive that is compressed and in the expected format for
         a board package (.tar.bz2).  Will write the contents to the specified
-        target file name.  Returns a tuple of (archive size in bytes, archive
-        SHA256 hash).
+        target file name, compressing with up to jobs processes.  Returns a
+        tuple of (archive size in bytes, archive SHA256 hash).
         """
         raise NotImplementedError
 
@@ -121,61 +673,316 @@ class DirectoryBoardPackage(BoardPackage):
         directory.
         """
         self._directory = directory
-        version = None
-        # Check that the directory exists and has a platform.txt that is
-        # readable (i.e. is an Arduino board package).
-        platform_file = os.path.join(directory, 'platform.txt')
-        with open(platform_file, 'r') as platform_txt:
-            # Parse out the platform version.
-            for line in platform_txt.readlines():
-                # Look for 'version=<platform version>' line and grab the version.
-                # Grab everything up to the end of line or start of comment (#).
-                match = re.match('version=([^#]+)', line, flags=re.IGNORECASE)
-                if match:
-                    version = match.group(1).strip()
+        version = self.read_version(directory)
         # Check that a version was found inside the package.
-        assert version is not None, 'Expected version for package: {0}'.format(name)
+        assert version is not None, 'Expected version for package: {0}'.format(kwargs.get('name'))
         # Set the origin location if it wasn't provided already.
         if origin is None:
             origin = 'directory: {0}'.format(directory)
         super(DirectoryBoardPackage, self).__init__(version=version, origin=origin,
             **kwargs)
 
-    def write_archive(self, target):
+    @staticmethod
+    def read_version(directory):
+        """Read the platform version from the platform.txt inside the specified
+        directory.  Returns None if no version was found.
+        """
+        # Check that the directory exists and has a platform.txt that is
+        # readable (i.e. is an Arduino board package).
+        platform_file = os.path.join(directory, 'platform.txt')
+        with profile_phase('read_version', directory):
+            with open(platform_file, 'r') as platform_txt:
+                return parse_platform_version(platform_txt.readlines())
+
+    @classmethod
+    def probe(cls, directory, **kwargs):
+        """Return a BoardPackage with the name and version of the package in
+        the specified directory, without preparing it to be archived.
+        """
+        version = cls.read_version(directory)
+        assert version is not None, 'Expected version for package: {0}'.format(kwargs.get('name'))
+        return BoardPackage(version=version, origin='directory: {0}'.format(directory),
+            **kwargs)
+
+    def get_tree_hash(self):
+        """Return a string that identifies the contents of the package which
+        go into its archive.  Hashes the names of all the directories and the
+        names, types, executable bits and contents of all the files in the
+        package directory, since the archive has an entry for each of them.
+        """
+        tree_hash = hashlib.sha256()
+        for root, dirs, files in os.walk(self._directory):
+            rel_root = os.path.relpath(root, self._directory)
+            rel_root = '' if rel_root == '.' else rel_root.replace(os.sep, '/') + '/'
+            # Skip the same .git files and folders as the archive, and walk
+            # in the same sorted order.
+            dirs[:] = sorted(filter(lambda x: not (rel_root + x).startswith('.git'), dirs))
+            for name in dirs:
+                if os.path.islink(os.path.join(root, name)):
+                    tree_hash.update('link {0}{1} {2}\0'.format(rel_root, name,
+                        os.readlink(os.path.join(root, name))).encode('utf-8'))
+                else:
+                    # Empty directories are archived too.
+                    tree_hash.update('dir {0}{1}\0'.format(rel_root, name).encode('utf-8'))
+            for name in sorted(files):
+                rel_path = rel_root + name
+                if rel_path.startswith('.git'):
+                    continue
+                path = os.path.join(root, name)
+                if os.path.islink(path):
+                    tree_hash.update('link {0} {1}\0'.format(rel_path, os.readlink(path)).encode('utf-8'))
+                    continue
+                executable = os.stat(path).st_mode & 0o111 != 0
+                tree_hash.update('file {0} {1}\0'.format(rel_path, executable).encode('utf-8'))
+                with open(path, 'rb') as source:
+                    for chunk in iter(lambda: source.read(1024*1024), b''):
+                        tree_hash.update(chunk)
+        return 'dir-sha256:{0}'.format(tree_hash.hexdigest())
+
+    def write_archive(self, target, jobs=1, deterministic=False, build_cache=None):
         """Create an archive that is compressed and in the expected format for
         a board package (.tar.bz2).  Will write the contents to the specified
-        target file name.  Returns a tuple of (archive size in bytes, archive
+        target file name.  If jobs is more than 1 the archive is compressed in
+        independent blocks across that many processes.  If deterministic is
+        True the archive entries get fixed timestamps and owners so the same
+        package contents always produce the same archive bytes.  If an
+        ArchiveBuildCache is specified as build_cache the archive is built in
+        deterministic mode and reused from the cache when the package contents
+        haven't changed.  Returns a tuple of (archive size in bytes, archive
         SHA256 hash).
         """
         # Create .tar.bz2 archive of the package directory.
         # Put files inside a folder with same name as archive (minus extension)
         arcname = os.path.basename(target)[:-len('.tar.bz2')]
-        with tarfile.open(target, 'w:bz2') as archive:
-            archive.add(self._directory,
-                arcname=arcname,
-                filter=lambda x: None if x.name.startswith(arcname + '/.git') else x)  # Don't add .git folder!
-        # Get the size of the archive.
-        size = os.stat(target).st_size
-        # Generate a SHA256 hash of the archive.
-        with open(target, 'rb') as archive:
-            sha256 = hashlib.sha256(archive.read()).hexdigest()
-        return (size, sha256)
+        # Look for the archive in the build cache.  The key covers everything
+        # that ends up in the archive bytes: folder name, package contents
+        # and compression mode.
+        cache_key = None
+        if build_cache is not None:
+            deterministic = True
+            cache_key = build_cache.get_key('bpt-archive-2', arcname, self.get_tree_hash(),
+                'parallel-bz2' if jobs > 1 else 'bz2')
+            cached = build_cache.get(cache_key, target)
+            if cached is not None:
+                return cached
+        def archive_filter(tarinfo):
+            # Don't add .git folder!
+            if tarinfo.name.startswith(arcname + '/.git'):
+                return None
+            if deterministic:
+                return _normalize_tarinfo(tarinfo)
+            return tarinfo
+        start = time.perf_counter()
+        with open(target, 'wb') as output:
+            # Hash and count the compressed bytes as they're written out.
+            hashed = HashingFileWriter(output)
+            # Note tarfile adds directory entries in sorted order, so only the
+            # entry metadata needs normalizing for deterministic archives.
+            if jobs > 1:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+                    compressed = ParallelBZ2Writer(hashed, executor, jobs)
+                    with tarfile.open(fileobj=compressed, mode='w|') as archive:
+                        archive.add(self._directory, arcname=arcname, filter=archive_filter)
+                    compressed.close()
+            else:
+                with tarfile.open(fileobj=hashed, mode='w:bz2') as archive:
+                    archive.add(self._directory, arcname=arcname, filter=archive_filter)
+        result = (hashed.get_size(), hashed.get_sha256())
+        if _profiler is not None:
+            _profiler.add_phase('sha256', arcname, start, hashed.get_hash_time())
+        if cache_key is not None:
+            build_cache.put(cache_key, target, *result)
+        return result
+
+
+class GitMirrorCache(object):
+    """Persistent on-disk cache of bare mirror clones of remote Git
+    repositories.  Each repository is cloned once and then kept up to date
+    with incremental fetches, so repeated runs only transfer new objects.  The
+    total size of the cache can be capped, in which case the least recently
+    used mirrors are deleted until the cache fits.
+    """
+
+    def __init__(self, cache_dir, max_size=None):
+        """Initialize mirror cache that lives in the specified cache_dir
+        directory (it will be created if it doesn't exist).  If max_size is
+        specified it's the maximum total size in bytes of all the mirrors.
+        """
+        self._cache_dir = cache_dir
+        self._max_size = max_size
+        # Lock for each mirror path so threads loading packages concurrently
+        # don't fetch into the same mirror at the same time.
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _lock(self, path):
+        """Return the lock that guards the specified mirror path."""
+        with self._locks_lock:
+            return self._locks.setdefault(path, threading.Lock())
+
+    def get_mirror_path(self, repo):
+        """Return the path of the mirror for the specified repository URL.  The
+        mirror directory is named after the repository with a hash of the full
+        URL appended to keep it unique.
+        """
+        name = posixpath.basename(repo.rstrip('/'))
+        if name.endswith('.git'):
+            name = name[:-len('.git')]
+        name = re.sub('[^A-Za-z0-9_.-]', '_', name)
+        digest = hashlib.sha1(repo.encode('utf-8')).hexdigest()[:12]
+        return os.path.join(self._cache_dir, '{0}-{1}.git'.format(name, digest))
+
+    def _update(self, repo, path):
+        """Bring the mirror at path up to date with the specified repository
+        URL, creating it if necessary.  Must be called with the mirror's lock
+        held.
+        """
+        from git import Repo
+        if os.path.exists(path):
+            logger.debug('GitMirrorCache fetching repo {0} into mirror {1}'.format(repo, path))
+            Repo(path).git.remote('update', '--prune')
+        else:
+            logger.debug('GitMirrorCache cloning repo {0} to mirror {1}'.format(repo, path))
+            # Clone into a temporary name first so an interrupted clone is
+            # never mistaken for a usable mirror.
+            partial_path = path + '.partial'
+            shutil.rmtree(partial_path, ignore_errors=True)
+            Repo.clone_from(repo, partial_path, mirror=True)
+            os.rename(partial_path, path)
+        # Bump the modification time to mark the mirror as recently used.
+        os.utime(path, None)
+
+    def update(self, repo):
+        """Make sure the mirror of the specified repository URL is up to date,
+        creating it if necessary.  Returns the path of the mirror.
+        """
+        path = self.get_mirror_path(repo)
+        with self._lock(path):
+            self._update(repo, path)
+        self.evict(keep=path)
+        return path
+
+    def clone(self, repo, target, ref=None):
+        """Update the mirror of the specified repository URL and then clone it
+        from the local mirror into the target directory.  The clone hard links
+        the mirror's objects so no data is transferred or copied, and its
+        origin remote points at the real repository URL.  If ref (a branch, tag
+        or commit hash) is specified it's checked out instead of the default
+        branch.  Returns the cloned Repo.
+        """
+        from git import GitCommandError, Repo
+        path = self.get_mirror_path(repo)
+        with self._lock(path):
+            self._update(repo, path)
+            logger.debug('GitMirrorCache cloning mirror {0} to directory {1}'.format(path, target))
+            cloned_repo = Repo.clone_from(path, target, no_checkout=ref is not None)
+        # Point origin back at the real remote so relative submodule URLs
+        # resolve the same as a direct clone.
+        cloned_repo.remotes.origin.set_url(repo)
+        self.evict(keep=path)
+        if ref is not None:
+            # Branches of the mirror are remote branches of the clone.
+            for candidate in ('origin/' + ref, ref):
+                try:
+                    commit = cloned_repo.git.rev_parse('--verify', candidate + '^{commit}')
+                    break
+                except GitCommandError:
+                    continue
+            else:
+                raise RuntimeError('Could not find ref {0} in repo {1}!'.format(ref, repo))
+            cloned_repo.git.checkout('--detach', commit)
+        return cloned_repo
+
+    def read_file(self, repo, path, ref='HEAD'):
+        """Update the mirror of the specified repository URL and return the
+        contents of the file at path (relative to the repository root, with
+        forward slashes) as of the specified ref.  The file is read straight
+        from the mirror's object database without a working tree.
+        """
+        from git import Repo
+        mirror_path = self.get_mirror_path(repo)
+        with self._lock(mirror_path):
+            self._update(repo, mirror_path)
+            contents = Repo(mirror_path).git.show('{0}:{1}'.format(ref, path))
+        self.evict(keep=mirror_path)
+        return contents
+
+    def get_mirrors(self):
+        """Return a list of (path, last used time, size in bytes) tuples for
+        every mirror in the cache, least recently used first.
+        """
+        mirrors = []
+        for name in os.listdir(self._cache_dir):
+            path = os.path.join(self._cache_dir, name)
+            if not name.endswith('.git') or not os.path.isdir(path):
+                continue
+            size = 0
+            for root, dirs, files in os.walk(path):
+                for filename in files:
+                    size += os.lstat(os.path.join(root, filename)).st_size
+            mirrors.append((path, os.stat(path).st_mtime, size))
+        mirrors.sort(key=lambda x: x[1])
+        return mirrors
+
+    def evict(self, keep=None):
+        """Delete least recently used mirrors until the cache is no bigger than
+        its maximum size.  The mirror at the keep path is never deleted.
+        """
+        if self._max_size is None:
+            return
+        mirrors = self.get_mirrors()
+        total = sum(map(lambda x: x[2], mirrors))
+        for path, used, size in mirrors:
+            if total <= self._max_size:
+                break
+            if path == keep:
+                continue
+            with self._lock(path):
+                logger.debug('GitMirrorCache evicting mirror {0} ({1} bytes)'.format(path, size))
+                shutil.rmtree(path, ignore_errors=True)
+            total -= size
 
 
 class GitBoardPackage(DirectoryBoardPackage):
     """Board package that lives in a remote Git repository."""
 
-    def __init__(self, repo, repo_dir, **kwargs):
+    def __init__(self, repo, repo_dir, mirror_cache=None, ref=None, depth=None, **kwargs):
         """Initialize board package using the contents of the specified Git
         repository.  Repo should be a URL that can be cloned with Git and its
-        contents will be cloned in a temporary directory.
+        contents will be cloned in a temporary directory.  If ref is specified
+        the package is built from that branch, tag or commit hash instead of
+        the default branch, and only that commit is fetched.  If depth is
+        specified only that many commits of history are fetched, for the
+        repository and its submodules.  If a GitMirrorCache is specified as
+        mirror_cache the repository will be fetched into the cache and the
+        temporary directory cloned from the local mirror, in which case depth
+        only applies to submodules.
         """
+        from git import Repo
         # Create a temporary directory to clone the repository.
         self._local_dir = tempfile.mkdtemp()
         # Clone the repo and its submodules to the temp directory.
-        logger.debug('GitBoardPackage cloning repo {0} to directory {1}'.format(repo, self._local_dir))
-        cloned_repo = Repo.clone_from(repo, self._local_dir)
-        cloned_repo.submodule_update(recursive=False)
+        with profile_phase('clone', repo):
+            if mirror_cache is not None:
+                cloned_repo = mirror_cache.clone(repo, self._local_dir, ref=ref)
+            elif ref is not None:
+                logger.debug('GitBoardPackage fetching ref {0} of repo {1} to directory {2}'.format(ref, repo, self._local_dir))
+                cloned_repo = self._fetch_ref(repo, self._local_dir, ref, depth=depth)
+                cloned_repo.git.checkout('--detach', 'FETCH_HEAD')
+            else:
+                logger.debug('GitBoardPackage cloning repo {0} to directory {1}'.format(repo, self._local_dir))
+                clone_args = {}
+                if depth is not None:
+                    clone_args = dict(depth=depth, single_branch=True)
+                cloned_repo = Repo.clone_from(repo, self._local_dir, **clone_args)
+            if depth is not None:
+                cloned_repo.git.submodule('update', '--init', '--depth', str(depth))
+            else:
+                cloned_repo.submodule_update(recursive=False)
+        self._cloned_repo = cloned_repo
+        self._repo_dir = repo_dir
 
         # Find path to repo dir inside cloned directory.
         target_dir = self._local_dir
@@ -188,9 +995,94 @@ class GitBoardPackage(DirectoryBoardPackage):
             # Now use the current OS path join to point at the repo_dir.
             target_dir = os.path.join(self._local_dir, *dirs)
         # Finish initializing using the cloned repo directory.
-        super(GitBoardPackage, self).__init__(target_dir, origin='git: {0}'.format(repo),
+        super(GitBoardPackage, self).__init__(target_dir, origin=self._origin(repo, ref),
             **kwargs)
 
+    @staticmethod
+    def _origin(repo, ref):
+        """Return the origin description of a package from the specified
+        repository URL and ref.
+        """
+        if ref is None:
+            return 'git: {0}'.format(repo)
+        return 'git: {0} ({1})'.format(repo, ref)
+
+    @staticmethod
+    def _fetch_ref(repo, local_dir, ref, **fetch_args):
+        """Create a repository in local_dir with the specified repository URL
+        as its origin and fetch only the commit at ref, a branch, tag or commit
+        hash, which is left in FETCH_HEAD.  Any keyword arguments (like depth)
+        are passed to git fetch.  Returns the Repo.
+        """
+        from git import Repo
+        fetched_repo = Repo.init(local_dir)
+        fetched_repo.create_remote('origin', repo)
+        fetch_args = dict((k, v) for k, v in fetch_args.items() if v is not None)
+        fetched_repo.git.fetch('origin', ref, **fetch_args)
+        return fetched_repo
+
+    @staticmethod
+    def _repo_path(repo_dir, filename):
+        """Return the path of filename inside repo_dir relative to the root of
+        the repository, using forward slashes like Git does.
+        """
+        if repo_dir is None:
+            return filename
+        repo_dir = posixpath.normpath(repo_dir)
+        if repo_dir == '.':
+            return filename
+        return posixpath.join(repo_dir, filename)
+
+    @classmethod
+    def probe(cls, repo, repo_dir, mirror_cache=None, ref=None, depth=None, **kwargs):
+        """Return a BoardPackage with the name and version of the package in
+        the specified Git repository (at ref if specified) without checking out
+        a working tree.  The platform.txt is read from the mirror in
+        mirror_cache if specified, otherwise from a temporary shallow clone
+        that only fetches the blobs it reads.
+        """
+        from git import Repo
+        platform_path = cls._repo_path(repo_dir, 'platform.txt')
+        if mirror_cache is not None:
+            platform_txt = mirror_cache.read_file(repo, platform_path, ref=ref or 'HEAD')
+        else:
+            local_dir = tempfile.mkdtemp()
+            try:
+                logger.debug('GitBoardPackage probing repo {0} in directory {1}'.format(repo, local_dir))
+                if ref is not None:
+                    probe_repo = cls._fetch_ref(repo, local_dir, ref, depth=1, filter='blob:none')
+                    commit = 'FETCH_HEAD'
+                else:
+                    probe_repo = Repo.clone_from(repo, local_dir, depth=1,
+                        single_branch=True, no_checkout=True, filter='blob:none')
+                    commit = 'HEAD'
+                platform_txt = probe_repo.git.show('{0}:{1}'.format(commit, platform_path))
+            finally:
+                shutil.rmtree(local_dir, ignore_errors=True)
+        version = parse_platform_version(platform_txt.splitlines())
+        assert version is not None, 'Expected version for package: {0}'.format(kwargs.get('name'))
+        return BoardPackage(version=version, origin=cls._origin(repo, ref), **kwargs)
+
+    @staticmethod
+    def get_remote_refs(repo, ref=None):
+        """Return the output of git ls-remote for ref (or HEAD if not specified)
+        in the specified repository URL, i.e. lines of commit hashes and ref
+        names.  This only asks the remote for its refs so it's a cheap way to
+        see whether a package might have changed.  A commit hash ref doesn't
+        match any remote refs and always returns an empty string.
+        """
+        from git import Git
+        return Git().ls_remote(repo, ref or 'HEAD')
+
+    def get_tree_hash(self):
+        """Return a string that identifies the contents of the package which
+        go into its archive.  Uses the Git tree id of the package directory,
+        which also pins the commits of any submodules inside it.
+        """
+        tree = self._repo_path(self._repo_dir, '')
+        tree_id = self._cloned_repo.git.rev_parse('HEAD:{0}'.format(tree))
+        return 'git-tree:{0}'.format(tree_id)
+
     def close(self):
         """Clean up temporary location that holds remote Git repository files."""
         if self._local_dir is not None:
@@ -198,22 +1090,75 @@ class GitBoardPackage(DirectoryBoardPackage):
             shutil.rmtree(self._local_dir, ignore_errors=True)
 
 
+def build_platform(package, output_board_dir, **archive_args):
+    """Build the archive for the specified board package in output_board_dir
+    and return the platform metadata dict that publishes it in the board index.
+    Any extra keyword arguments are passed to the package's write_archive.
+    """
+    archive_path = os.path.join(output_board_dir, package.get_archive_name())
+    with profile_phase('write_archive', package.get_name()):
+        size, sha256 = package.write_archive(archive_path, **archive_args)
+    # Convert the package template from JSON to a platform metadata dict that
+    # can be inserted in the board index.
+    template_params = {
+        'version': package.get_version(),
+        'filename': package.get_archive_name(),
+        'sha256': sha256,
+        'size': size
+    }
+    return json.loads(package.get_template().format(**template_params))
+
+
 class BoardIndex(object):
     """Board index that is the master list of packages published to Arduino
     clients.
     """
 
-    def __init__(self, index_data):
+    def __init__(self, index_data, json_backend=None, source_file=None):
         """Initialize board index with JSON decoded dict of board index data.
+        The index is serialized with the specified JSONBackend, or the standard
+        library json module if not specified.  If source_file is the path of
+        the file the index data was decoded from, new platforms will be spliced
+        into a copy of that file when writing instead of serializing the whole
+        index again.
         """
         self._data = index_data
+        self._json_backend = json_backend if json_backend is not None else JSONBackend()
+        # Remember the source file and its state so it can be spliced into, and
+        # the platforms that have been added since it was loaded.
+        self._source_file = source_file
+        self._source_stat = None
+        if source_file is not None:
+            stat = os.stat(source_file)
+            self._source_stat = (stat.st_size, stat.st_mtime_ns)
+        self._added_platforms = []
+        self._modified = False
         # Load all the packages and add them to a dict indexed by package name
         # for quick lookup.
         self._packages = {}
+        # Index of the platforms in each package by (package name, platform
+        # name).  Each entry holds a list of parsed versions in ascending order
+        # and a matching list of the platform dicts, so the latest version is
+        # always the last item.
+        self._platform_versions = {}
+        self._platform_entries = {}
         for package in self._data.get('packages', []):
             name = package.get('name')
             assert name is not None and name != '', 'Board index package must specify a name!'
             self._packages[name] = package
+            for platform in package.get('platforms', []):
+                self._index_platform(name, platform)
+
+    def _index_platform(self, package, platform):
+        """Add a platform of the specified package name to the version index."""
+        key = (package, platform.get('name'))
+        versions = self._platform_versions.setdefault(key, [])
+        entries = self._platform_entries.setdefault(key, [])
+        version = parse_version(platform.get('version', ''))
+        # Insert after any equal versions so ties keep their file order.
+        position = bisect.bisect_right(versions, version)
+        versions.insert(position, version)
+        entries.insert(position, platform)
 
     def get_packages(self):
         """Retrieve a list of all the packages."""
@@ -222,24 +1167,213 @@ class BoardIndex(object):
     def get_platforms(self, package, name=None):
         """Retrieve a list of all platforms for the specified package name.
         Can optionally filter by platforms of the specified name (i.e. to get
-        all the different versions of that platform).
+        all the different versions of that platform), in which case the
+        platforms are sorted from oldest to newest version.
         """
         platforms = self._packages[package].get('platforms', [])
         if name is None:
             return platforms
         else:
-            return filter(lambda x: x.get('name') == name, platforms)
+            return list(self._platform_entries.get((package, name), []))
+
+    def get_downloads(self):
+        """Generate a (package name, name, version, entry) tuple for every
+        downloadable archive in the index, i.e. each platform and each system
+        of each tool.  The entry is the dict with the url, archiveFileName,
+        checksum and size of the archive.
+        """
+        for package_name, package in self._packages.items():
+            for platform in package.get('platforms', []):
+                if 'url' in platform:
+                    yield (package_name, platform.get('name'), platform.get('version'), platform)
+            for tool in package.get('tools', []):
+                for system in tool.get('systems', []):
+                    if 'url' in system:
+                        yield (package_name, tool.get('name'), tool.get('version'), system)
+
+    def latest_version(self, package, name):
+        """Return the most recent version (as parsed by parse_version) of the
+        platform with the specified name in the specified package, or None if
+        there is no such platform.
+        """
+        versions = self._platform_versions.get((package, name))
+        if not versions:
+            return None
+        return versions[-1]
 
     def add_platform(self, package, platform):
         """Add a platform to the specified package."""
         parent = self._packages[package]
-        parent.get('platforms', []).append(platform)
+        parent.setdefault('platforms', []).append(platform)
+        self._index_platform(package, platform)
+        self._added_platforms.append((package, platform))
+
+    def prune(self, keep=None, min_version=None, architecture=None, prune_tools=False):
+        """Return a new BoardIndex with only some of the platforms of this one.
+        If keep is specified only that many of the most recent versions of each
+        platform are kept, and if min_version is specified only versions at
+        least that recent are kept, but the most recent version of a platform is
+        always kept.  If architecture is specified only platforms of that
+        architecture are kept and packages without any platforms or tools left
+        are removed.  If prune_tools is true (or an architecture is specified),
+        tools that no kept platform depends on are removed.
+        """
+        if min_version is not None:
+            min_version = parse_version(min_version)
+        kept = set()
+        for (package, name), entries in self._platform_entries.items():
+            versions = self._platform_versions[(package, name)]
+            candidates = list(zip(versions, entries))
+            if architecture is not None:
+                candidates = [x for x in candidates if x[1].get('architecture') == architecture]
+            if len(candidates) == 0:
+                continue
+            latest = candidates[-1]
+            if min_version is not None:
+                candidates = [x for x in candidates if x[0] >= min_version]
+            if keep is not None:
+                candidates = candidates[-keep:] if keep > 0 else []
+            if latest not in candidates:
+                candidates.append(latest)
+            kept.update(id(x[1]) for x in candidates)
+        platforms = collections.OrderedDict()
+        tools = set()
+        for package in self._data.get('packages', []):
+            platforms[package.get('name')] = [x for x in package.get('platforms', []) if id(x) in kept]
+            for platform in platforms[package.get('name')]:
+                for field in ToolResolver.DEPENDENCY_FIELDS:
+                    for tool in platform.get(field, []):
+                        tools.add((tool.get('packager'), tool.get('name'), tool.get('version')))
+        data = collections.OrderedDict((k, v) for k, v in self._data.items() if k != 'packages')
+        data['packages'] = []
+        for package in self._data.get('packages', []):
+            name = package.get('name')
+            pruned = collections.OrderedDict(package)
+            pruned['platforms'] = platforms[name]
+            if 'tools' in package and (prune_tools or architecture is not None):
+                # Discovery and monitor dependencies may leave out the version
+                # to use the latest, so they keep every version of the tool.
+                pruned['tools'] = [x for x in package['tools']
+                    if (name, x.get('name'), x.get('version')) in tools or
+                       (name, x.get('name'), None) in tools]
+            if architecture is not None and len(pruned['platforms']) == 0 and \
+               len(pruned.get('tools', [])) == 0:
+                continue
+            data['packages'].append(pruned)
+        return BoardIndex(data, json_backend=self._json_backend)
 
     def write_json(self):
         """Serialize the board index data into JSON so it can be written to a
         file.  Will return the JSON string of the data.
         """
-        return json.dumps(self._data, indent=2, separators=(',', ': '))
+        with profile_phase('write_json'):
+            return self._json_backend.dumps(self._data)
+
+    def _splice_platforms(self, text):
+        """Find where the platforms added since loading go in the source file
+        text, which must be in the layout written by write_json.  Returns a
+        list of (start offset, end offset, replacement string) edits that turn
+        the source into the updated index, or None if the layout of the text
+        wasn't recognized.
+        """
+        # The packages array holds one object per package, each opening on a
+        # line indented with 4 spaces, and closes on a line indented with 2.
+        header = '{\n  "packages": [\n'
+        if not text.startswith(header):
+            return None
+        packages_end = text.find('\n  ]', len(header) - 1)
+        if packages_end == -1:
+            return None
+        starts = []
+        position = text.find('\n    {\n', len(header) - 1, packages_end)
+        while position != -1:
+            starts.append(position)
+            position = text.find('\n    {\n', position + 1, packages_end)
+        packages = self._data.get('packages', [])
+        if len(starts) != len(packages):
+            return None
+        starts.append(packages_end)
+        # Group the new platforms by the position of their package.
+        positions = dict((package.get('name'), i) for i, package in enumerate(packages))
+        added = collections.OrderedDict()
+        for package, platform in self._added_platforms:
+            added.setdefault(positions[package], []).append(platform)
+        edits = []
+        for i, platforms in sorted(added.items()):
+            start, end = starts[i], starts[i + 1]
+            # Make sure this is the expected package.
+            name_line = '\n      "name": {0}'.format(self._json_backend.dumps(packages[i].get('name')))
+            name = text.find(name_line, start, end)
+            if name == -1 or text[name + len(name_line)] not in ',\n':
+                return None
+            # Platforms are indented 8 spaces inside the package's platforms
+            # array, which closes on a line indented with 6.
+            new_platforms = ',\n'.join(map(
+                lambda x: '\n'.join(map(lambda line: ' '*8 + line,
+                    self._json_backend.dumps(x).split('\n'))),
+                platforms))
+            empty = text.find('\n      "platforms": []', start, end)
+            if empty != -1:
+                empty += len('\n      "platforms": [')
+                edits.append((empty, empty, '\n' + new_platforms + '\n      '))
+                continue
+            platforms_start = text.find('\n      "platforms": [\n', start, end)
+            if platforms_start == -1:
+                return None
+            platforms_end = text.find('\n      ]', platforms_start, end)
+            if platforms_end == -1 or not text.endswith('\n        }', 0, platforms_end):
+                return None
+            edits.append((platforms_end, platforms_end, ',\n' + new_platforms))
+        return edits
+
+    def _write_spliced(self, output):
+        """Write the updated index to the output file by splicing the added
+        platforms into the source file.  Returns False without writing anything
+        if the source file can't be spliced.
+        """
+        if self._source_file is None or self._modified:
+            return False
+        stat = os.stat(self._source_file)
+        if (stat.st_size, stat.st_mtime_ns) != self._source_stat:
+            logger.debug('Board index {0} changed since loading, not splicing'.format(self._source_file))
+            return False
+        with open(self._source_file, 'r', encoding='utf-8', newline='') as source:
+            text = source.read()
+        edits = self._splice_platforms(text)
+        if edits is None:
+            logger.debug('Board index {0} layout not recognized, not splicing'.format(self._source_file))
+            return False
+        position = 0
+        for start, end, value in edits:
+            output.write(text[position:start])
+            output.write(value)
+            position = end
+        output.write(text[position:])
+        return True
+
+    def write_file(self, path):
+        """Write the board index JSON to the specified file path.  If the index
+        was loaded from a source file in the layout written by write_json, the
+        new platforms are spliced into a copy of it, otherwise the whole index is
+        serialized.  The data is written to a temporary file that then replaces
+        the target, so readers never see a partially written index.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with profile_phase('write_index', path), \
+                 os.fdopen(fd, 'w', encoding='utf-8', newline='') as bi:
+                if not self._write_spliced(bi):
+                    bi.write(self.write_json())
+            # Keep the permissions of the index being replaced.
+            if os.path.exists(path):
+                shutil.copymode(path, temp_path)
+            else:
+                os.chmod(temp_path, 0o644)
+            os.replace(temp_path, path)
+        except:
+            os.remove(temp_path)
+            raise
 
     def transform_urls(self, transforms):
         """Transform all the urls inside platforms using the specified list
@@ -249,6 +1383,8 @@ class BoardIndex(object):
         'http://') would convert SSL to non-SSL.  Note that target searching is
         case insensitive!
         """
+        # The source file can't be spliced into after changing existing data.
+        self._modified = True
         # Walk all the packages and platforms inside them.
         for package in self._data.get('packages', []):
             for platform in package.get('platforms', []):
@@ -265,6 +1401,571 @@ class BoardIndex(object):
                         # Replace target with value.
                         platform['url'] = ''.join([url[:start], value, url[start+len(target):]])
 
+class _JSONScanner(object):
+    """Incremental scanner over the bytes of a JSON file that walks objects and
+    arrays and returns the raw bytes of values, so a large document can be
+    processed one small value at a time.  Only the value being scanned is kept
+    in memory.  Positions are absolute offsets in the file.
+    """
+
+    # Everything up to the next bracket that opens a nested container or
+    # closes one, or the next string that isn't completely in the buffer,
+    # matched in one go.  Containers without nested containers (like the
+    # objects in a boards list) are matched whole.  The patterns are written
+    # so there's only one way to match any text, otherwise a container or
+    # string cut off by the end of the buffer would backtrack exponentially.
+    _STRING = rb'"[^"\\]*(?:\\.[^"\\]*)*"'
+    _FLAT = rb'[^"\[\]{}]*(?:' + _STRING + rb'[^"\[\]{}]*)*'
+    _CONTENT = re.compile(rb'[^"\[\]{}]*(?:(?:' + _STRING + rb'|\{' + _FLAT + rb'\}|\[' + _FLAT +
+        rb'\])[^"\[\]{}]*)*', re.DOTALL)
+    _STRING_BODY = re.compile(rb'[^"\\]*(?:\\.[^"\\]*)*', re.DOTALL)
+    _WHITESPACE = re.compile(rb'[ \t\n\r]*')
+    _SCALAR_END = re.compile(rb'[ \t\n\r,\]}]')
+
+    def __init__(self, fileobj, chunk_size=1024*1024):
+        """Initialize scanner reading from the start of binary file fileobj."""
+        self._file = fileobj
+        self._chunk_size = chunk_size
+        self._buffer = b''
+        self._base = 0
+        self._pos = 0
+        self._keep = 0
+
+    def _fill(self):
+        """Read the next chunk of the file into the buffer, dropping the bytes
+        before the kept position.  Returns False at the end of the file.
+        """
+        chunk = self._file.read(self._chunk_size)
+        if not chunk:
+            return False
+        self._buffer = self._buffer[self._keep - self._base:] + chunk
+        self._base = self._keep
+        return True
+
+    def _search(self, pattern):
+        """Return the absolute position of the next match of pattern at or
+        after the current position, reading more of the file as needed.
+        """
+        while True:
+            match = pattern.search(self._buffer, self._pos - self._base)
+            if match is not None:
+                return self._base + match.start()
+            self._pos = self._base + len(self._buffer)
+            if not self._fill():
+                raise ValueError('Unexpected end of JSON at offset {0}'.format(self._pos))
+
+    def peek(self):
+        """Skip whitespace and return the next byte without consuming it, or an
+        empty byte string at the end of the file.
+        """
+        while True:
+            match = self._WHITESPACE.match(self._buffer, self._pos - self._base)
+            self._pos = self._base + match.end()
+            if self._pos < self._base + len(self._buffer):
+                return self._buffer[self._pos - self._base:self._pos - self._base + 1]
+            self._keep = self._pos
+            if not self._fill():
+                return b''
+
+    def expect(self, char):
+        """Consume the next byte, which must be char."""
+        if self.peek() != char:
+            raise ValueError('Expected {0} at offset {1}'.format(char.decode('ascii'), self._pos))
+        self._pos += 1
+
+    def _skip_string(self):
+        """Move past the string starting at the current position."""
+        self._pos += 1
+        while True:
+            match = self._STRING_BODY.match(self._buffer, self._pos - self._base)
+            self._pos = self._base + match.end()
+            if self._pos < self._base + len(self._buffer) and \
+               self._buffer[self._pos - self._base] == ord('"'):
+                self._pos += 1
+                return
+            # The string (or an escape sequence) continues in the next chunk.
+            if not self._fill():
+                raise ValueError('Unexpected end of JSON at offset {0}'.format(self._pos))
+
+    def skip_value(self):
+        """Move past the next value and return its (start, end) offsets."""
+        first = self.peek()
+        start = self._pos
+        self._keep = start
+        if first == b'"':
+            self._skip_string()
+        elif first in (b'{', b'['):
+            # Step inside the container so its own closing bracket isn't
+            # matched as part of the content.
+            self._pos += 1
+            depth = 1
+            while True:
+                match = self._CONTENT.match(self._buffer, self._pos - self._base)
+                self._pos = self._base + match.end()
+                if self._pos == self._base + len(self._buffer):
+                    if not self._fill():
+                        raise ValueError('Unexpected end of JSON at offset {0}'.format(self._pos))
+                    continue
+                char = self._buffer[self._pos - self._base]
+                if char == ord('"'):
+                    self._skip_string()
+                    continue
+                self._pos += 1
+                depth += 1 if char in b'{[' else -1
+                if depth == 0:
+                    break
+        elif first == b'':
+            raise ValueError('Unexpected end of JSON at offset {0}'.format(start))
+        else:
+            try:
+                self._pos = self._search(self._SCALAR_END)
+            except ValueError:
+                # A scalar can end the file.
+                self._pos = self._base + len(self._buffer)
+        return (start, self._pos)
+
+    def get_bytes(self, start, end):
+        """Return the raw bytes of the value that skip_value just moved past,
+        given its (start, end) offsets.
+        """
+        value = self._buffer[start - self._base:end - self._base]
+        self._keep = end
+        return value
+
+    def read_value(self):
+        """Return the raw bytes of the next value and move past it."""
+        return self.get_bytes(*self.skip_value())
+
+    def iter_object(self):
+        """Generate the keys of the object at the current position.  The value
+        of each key must be consumed before getting the next key.
+        """
+        self.expect(b'{')
+        if self.peek() == b'}':
+            self._pos += 1
+            return
+        while True:
+            key = json.loads(self.read_value())
+            self.expect(b':')
+            yield key
+            if self.peek() == b'}':
+                self._pos += 1
+                return
+            self.expect(b',')
+
+    def iter_array(self):
+        """Generate the index of each item in the array at the current
+        position.  Each item must be consumed before getting the next one.
+        """
+        self.expect(b'[')
+        if self.peek() == b']':
+            self._pos += 1
+            return
+        i = 0
+        while True:
+            yield i
+            i += 1
+            if self.peek() == b']':
+                self._pos += 1
+                return
+            self.expect(b',')
+
+
+class PlatformSummary(object):
+    """Compact summary of a platform in a StreamingBoardIndex, with the offset
+    and length of the platform's JSON in the index file so the whole platform
+    can be decoded on demand.
+    """
+
+    __slots__ = ('package', 'name', 'architecture', 'version', 'url', 'archive_file_name',
+                 'checksum', 'size', 'offset', 'length')
+
+    def __init__(self, package, name, architecture, version, url, archive_file_name,
+                 checksum, size, offset, length):
+        """Initialize summary of a platform of the specified package name,
+        whose JSON is at offset and length in the index file.
+        """
+        # Names repeat for every version so share one copy of each.
+        self.package = sys.intern(package)
+        self.name = sys.intern(name)
+        self.architecture = sys.intern(architecture)
+        self.version = version
+        self.url = url
+        self.archive_file_name = archive_file_name
+        self.checksum = checksum
+        self.size = size
+        self.offset = offset
+        self.length = length
+
+    def get_download(self):
+        """Return a dict with the url, archiveFileName, checksum and size of
+        the platform's archive, like the fields of the platform itself.
+        """
+        return {'url': self.url, 'archiveFileName': self.archive_file_name,
+                'checksum': self.checksum, 'size': self.size}
+
+
+class StreamingBoardIndex(object):
+    """Read-only board index for very large index files.  The file is scanned
+    incrementally and only a compact PlatformSummary of each platform is kept
+    in memory, so memory use doesn't depend on how large the platforms' board
+    and tool lists are.  Full platform and tool objects are decoded from the
+    file when asked for.
+    """
+
+    def __init__(self, source_file, json_backend=None):
+        """Initialize board index by scanning the specified board index JSON
+        file.  Platforms and tools are decoded with the specified JSONBackend,
+        or the standard library json module if not specified.
+        """
+        self._source_file = source_file
+        self._json_backend = json_backend if json_backend is not None else JSONBackend()
+        # Package fields (except platforms and tools) by package name, the
+        # summaries of the platforms in each package in file order and by
+        # (package name, platform name) in version order, and the (offset,
+        # length) of each tool in each package.
+        self._packages = collections.OrderedDict()
+        self._package_platforms = {}
+        self._platforms = {}
+        self._tools = {}
+        with open(source_file, 'rb') as index_file:
+            scanner = _JSONScanner(index_file)
+            for key in scanner.iter_object():
+                if key != 'packages':
+                    scanner.skip_value()
+                    continue
+                for i in scanner.iter_array():
+                    self._scan_package(scanner)
+        # Sort the platforms of each name from oldest to newest version.
+        for key, platforms in self._platforms.items():
+            platforms.sort(key=lambda x: parse_version(x.version))
+
+    def _scan_package(self, scanner):
+        """Scan the package object at the scanner's position.  Each platform
+        is decoded to summarize it and then thrown away.
+        """
+        fields = collections.OrderedDict()
+        platforms = []
+        tools = []
+        for key in scanner.iter_object():
+            if key == 'platforms':
+                for i in scanner.iter_array():
+                    start, end = scanner.skip_value()
+                    platform = self._json_backend.loads(scanner.get_bytes(start, end))
+                    # The package name might come after its platforms so only
+                    # keep what the summary needs until it's known.
+                    platforms.append((platform.get('name', ''), platform.get('architecture', ''),
+                        platform.get('version', ''), platform.get('url'), platform.get('archiveFileName'),
+                        platform.get('checksum'), platform.get('size'), start, end - start))
+            elif key == 'tools':
+                for i in scanner.iter_array():
+                    start, end = scanner.skip_value()
+                    tools.append((start, end - start))
+            else:
+                fields[key] = self._json_backend.loads(scanner.read_value())
+        name = fields.get('name')
+        assert name is not None and name != '', 'Board index package must specify a name!'
+        self._packages[name] = fields
+        summaries = [PlatformSummary(name, *x) for x in platforms]
+        self._package_platforms[name] = summaries
+        for summary in summaries:
+            self._platforms.setdefault((summary.package, summary.name), []).append(summary)
+        self._tools[name] = tools
+
+    def _decode(self, offset, length):
+        """Decode the JSON value at offset and length in the index file."""
+        with open(self._source_file, 'rb') as index_file:
+            index_file.seek(offset)
+            return self._json_backend.loads(index_file.read(length))
+
+    def get_package_names(self):
+        """Return a list of the names of all the packages."""
+        return list(self._packages.keys())
+
+    def get_package(self, package):
+        """Return a dict of the fields of the specified package name, without
+        its platforms and tools.
+        """
+        return self._packages[package]
+
+    def get_platforms(self, package, name=None):
+        """Retrieve a list of the PlatformSummary of all platforms for the
+        specified package name.  Can optionally filter by platforms of the
+        specified name, in which case the platforms are sorted from oldest to
+        newest version.
+        """
+        if name is None:
+            return list(self._package_platforms[package])
+        return list(self._platforms.get((package, name), []))
+
+    def get_platform(self, summary):
+        """Decode and return the full platform dict of a PlatformSummary."""
+        return self._decode(summary.offset, summary.length)
+
+    def get_tools(self, package):
+        """Generate the decoded tool dicts of the specified package name, one
+        at a time.
+        """
+        for offset, length in self._tools[package]:
+            yield self._decode(offset, length)
+
+    def get_downloads(self):
+        """Generate a (package name, name, version, entry) tuple for every
+        downloadable archive in the index, like BoardIndex.get_downloads.
+        """
+        for package in self._packages:
+            for summary in self._package_platforms[package]:
+                if summary.url is not None:
+                    yield (package, summary.name, summary.version, summary.get_download())
+            for tool in self.get_tools(package):
+                for system in tool.get('systems', []):
+                    if 'url' in system:
+                        yield (package, tool.get('name'), tool.get('version'), system)
+
+    def latest_version(self, package, name):
+        """Return the most recent version (as parsed by parse_version) of the
+        platform with the specified name in the specified package, or None if
+        there is no such platform.
+        """
+        platforms = self._platforms.get((package, name))
+        if not platforms:
+            return None
+        return parse_version(platforms[-1].version)
+
+
+class BoardQueryIndex(object):
+    """Inverted index over a board index that answers which platform versions
+    have a board, architecture or tool dependency without decoding and
+    scanning the whole board index.  The index is persisted to a JSON cache
+    file that's rebuilt when the SHA256 hash of the board index changes.
+    """
+
+    # Bump when the layout of the persisted data changes.
+    FORMAT = 1
+
+    # Platform fields kept in the summary of each platform.
+    SUMMARY_FIELDS = ('name', 'architecture', 'version', 'url', 'archiveFileName', 'checksum', 'size')
+
+    def __init__(self, data):
+        """Initialize query index with its decoded data, as built by build."""
+        self._data = data
+        self._board_names = dict((x.lower(), x) for x in data['boards'])
+
+    @classmethod
+    def build(cls, index_data, source_sha256=None):
+        """Build query index from JSON decoded dict of board index data, with
+        the SHA256 hash of the index file it was decoded from.
+        """
+        platforms = []
+        for package in index_data.get('packages', []):
+            for platform in package.get('platforms', []):
+                summary = dict((x, platform.get(x)) for x in cls.SUMMARY_FIELDS)
+                summary['package'] = package.get('name')
+                platforms.append((summary, platform))
+        # Sort platforms by version so every query returns oldest to newest.
+        platforms.sort(key=lambda x: (x[0]['package'], x[0]['name'] or '',
+            parse_version(x[0]['version'] or '')))
+        boards = {}
+        architectures = {}
+        tools = {}
+        for i, (summary, platform) in enumerate(platforms):
+            for board in platform.get('boards', []):
+                boards.setdefault(board.get('name'), []).append(i)
+            architectures.setdefault('{0}:{1}'.format(summary['package'],
+                summary['architecture']), []).append(i)
+            for tool in platform.get('toolsDependencies', []):
+                tools.setdefault('{0}:{1}'.format(tool.get('packager'), tool.get('name')),
+                    []).append([i, tool.get('version')])
+        return cls({
+            'format': cls.FORMAT,
+            'source_sha256': source_sha256,
+            'platforms': [x[0] for x in platforms],
+            'boards': boards,
+            'architectures': architectures,
+            'tools': tools
+        })
+
+    @classmethod
+    def load(cls, index_file, cache_file, json_backend=None):
+        """Return the query index of the specified board index file.  It's read
+        from the cache file if that was built from the same board index
+        contents, otherwise it's built and the cache file is written.
+        """
+        json_backend = json_backend if json_backend is not None else JSONBackend()
+        with open(index_file, 'rb') as bi:
+            index_bytes = bi.read()
+        source_sha256 = hashlib.sha256(index_bytes).hexdigest()
+        if os.path.exists(cache_file):
+            try:
+                with open(cache_file, 'rb') as cache:
+                    data = json_backend.loads(cache.read())
+                if data.get('format') == cls.FORMAT and data.get('source_sha256') == source_sha256:
+                    return cls(data)
+            except ValueError:
+                pass
+            logger.debug('Query index {0} is out of date, rebuilding'.format(cache_file))
+        query_index = cls.build(json_backend.loads(index_bytes), source_sha256)
+        directory = os.path.dirname(os.path.abspath(cache_file))
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as cache:
+                json.dump(query_index._data, cache, separators=(',', ':'))
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, cache_file)
+        except:
+            os.remove(temp_path)
+            raise
+        return query_index
+
+    def _platforms(self, indices):
+        """Return a dict of platform summaries by their index."""
+        return collections.OrderedDict((i, dict(self._data['platforms'][i])) for i in indices)
+
+    def find_boards(self, text):
+        """Return a list of platform summaries with a board named text, or if
+        there is no such board with a board whose name contains text.  The
+        comparison is case insensitive.  Each summary has a 'boards' key with
+        the list of matching board names.
+        """
+        text = text.lower()
+        if text in self._board_names:
+            names = [self._board_names[text]]
+        else:
+            names = [x for x in self._data['boards'] if text in x.lower()]
+        platforms = collections.OrderedDict()
+        for name in names:
+            for i in self._data['boards'][name]:
+                platforms.setdefault(i, []).append(name)
+        results = self._platforms(sorted(platforms))
+        for i, summary in results.items():
+            summary['boards'] = platforms[i]
+        return list(results.values())
+
+    def find_architecture(self, package, architecture):
+        """Return a list of platform summaries for the specified package name
+        and architecture.
+        """
+        return list(self._platforms(self._data['architectures'].get(
+            '{0}:{1}'.format(package, architecture), [])).values())
+
+    def find_tool(self, name, packager=None, version=None):
+        """Return a list of platform summaries that depend on the tool with
+        the specified name, and optionally packager and version.  Each summary
+        has a 'tools' key with the list of matching 'packager:name@version'
+        dependencies.
+        """
+        platforms = collections.OrderedDict()
+        for key, dependencies in self._data['tools'].items():
+            tool_packager, tool_name = key.split(':', 1)
+            if tool_name != name or (packager is not None and tool_packager != packager):
+                continue
+            for i, tool_version in dependencies:
+                if version is None or tool_version == version:
+                    platforms.setdefault(i, []).append('{0}@{1}'.format(key, tool_version))
+        results = self._platforms(sorted(platforms))
+        for i, summary in results.items():
+            summary['tools'] = platforms[i]
+        return list(results.values())
+
+
+class ToolResolver(object):
+    """Resolves the tools that platforms depend on to the archives an Arduino
+    client downloads for each host.  Tools are looked up by (packager, name,
+    version) across all the packages of one or more board indices, so
+    platforms can depend on tools published by other packages (like the
+    arduino package's compilers).  Resolutions are memoized since most
+    platform versions share the same dependencies.
+    """
+
+    # Patterns of the tool system hosts each client host can install, in
+    # order of preference.  Systems with the host 'all' work on every host.
+    HOST_PATTERNS = collections.OrderedDict([
+        ('x86_64-linux-gnu', [r'x86_64-.*linux-gnu.*']),
+        ('i686-linux-gnu', [r'i[3456]86-.*linux-gnu.*']),
+        ('arm-linux-gnueabihf', [r'arm.*-linux-gnueabihf.*']),
+        ('aarch64-linux-gnu', [r'(aarch64|arm64)-linux-gnu.*']),
+        ('x86_64-apple-darwin', [r'(amd64|x86_64|i[3456]86)-apple-darwin.*']),
+        ('arm64-apple-darwin', [r'arm64-apple-darwin.*', r'(amd64|x86_64|i[3456]86)-apple-darwin.*']),
+        ('x86_64-mingw32', [r'(amd64|x86_64)-.*(mingw32|cygwin)', r'i[3456]86-.*(mingw32|cygwin)']),
+        ('i686-mingw32', [r'i[3456]86-.*(mingw32|cygwin)'])
+    ])
+
+    # Platform fields that list tool dependencies.
+    DEPENDENCY_FIELDS = ('toolsDependencies', 'discoveryDependencies', 'monitorDependencies')
+
+    def __init__(self, indices):
+        """Initialize resolver with a list of JSON decoded dicts of board index
+        data.  If the same tool version is in more than one index the first
+        one wins.
+        """
+        self._tools = {}
+        for index_data in indices:
+            for package in index_data.get('packages', []):
+                for tool in package.get('tools', []):
+                    key = (package.get('name'), tool.get('name'), tool.get('version'))
+                    self._tools.setdefault(key, tool.get('systems', []))
+        self._host_patterns = dict((host, [re.compile(x) for x in patterns + ['all']])
+            for host, patterns in self.HOST_PATTERNS.items())
+        self._resolved_tools = {}
+        self._resolved_dependencies = {}
+
+    def get_hosts(self):
+        """Return the list of hosts that can be resolved."""
+        return list(self.HOST_PATTERNS.keys())
+
+    def get_dependencies(self, platform):
+        """Return a tuple of the (packager, name, version) tuples of the tools
+        the specified platform dict depends on.
+        """
+        return tuple((x.get('packager'), x.get('name'), x.get('version'))
+            for field in self.DEPENDENCY_FIELDS for x in platform.get(field, []))
+
+    def resolve_tool(self, tool, host):
+        """Return the system dict of the archive to download for the tool
+        (packager, name, version) tuple on the specified host.  Raises a
+        KeyError if the tool isn't in any index or a LookupError if it has no
+        archive for the host.
+        """
+        key = (tool, host)
+        if key not in self._resolved_tools:
+            systems = self._tools.get(tool)
+            result = None
+            if systems is None:
+                result = KeyError('tool is not in the index')
+            else:
+                for pattern in self._host_patterns[host]:
+                    result = next((x for x in systems if pattern.fullmatch(x.get('host', ''))), None)
+                    if result is not None:
+                        break
+                else:
+                    result = LookupError('tool has no archive for host {0}'.format(host))
+            self._resolved_tools[key] = result
+        result = self._resolved_tools[key]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def resolve(self, platform, host):
+        """Resolve the tools that the specified platform dict depends on for a
+        host.  Returns a tuple of a list of (tool, system dict) tuples for each
+        tool archive to download, and a list of (tool, reason) tuples for each
+        dangling dependency that can't be resolved.  Tools are (packager, name,
+        version) tuples.
+        """
+        key = (self.get_dependencies(platform), host)
+        if key not in self._resolved_dependencies:
+            systems = []
+            dangling = []
+            for tool in key[0]:
+                try:
+                    systems.append((tool, self.resolve_tool(tool, host)))
+                except LookupError as ex:
+                    dangling.append((tool, ex.args[0]))
+            self._resolved_dependencies[key] = (systems, dangling)
+        systems, dangling = self._resolved_dependencies[key]
+        return (list(systems), list(dangling))
+
+
 class BoardConfig(object):
     """Represents a board configuration INI file.  This configuration can define
     a list of board package locations, either as directories or Git repositories.
@@ -273,7 +1974,7 @@ class BoardConfig(object):
     each pacakge location.
     """
 
-    def __init__(self, board_config):
+    def __init__(self, board_config, max_workers=4, mirror_cache=None):
         """Initialize board package config using the specified board_config
         file path.  If board_config is None or empty then no board pacakges will
         be loaded.  Otherwise board_config should point at an INI file with
@@ -281,8 +1982,22 @@ class BoardConfig(object):
           - package = name of parent package inside board index (required)
           - directory = path to a directory on the machine with the board package
           - repo = git repository URL that holds the board package
+        Packages are not loaded until they are requested with get_package or
+        get_packages.  When several packages are requested at once they will be
+        loaded concurrently with up to max_workers threads.  Git packages will
+        be fetched through mirror_cache if a GitMirrorCache is specified.
         """
-        self._packages = []
+        self._max_workers = max_workers
+        # Factories (keyed by package name, in config file order) that will
+        # create each package when it's first needed, and the packages that
+        # have been created so far, plus a future for each package that is
+        # being created by a thread right now.
+        self._sources = {}
+        self._probes = {}
+        self._locations = {}
+        self._packages = {}
+        self._loading = {}
+        self._lock = threading.Lock()
         # Load the INI file and process all the sections.
         self._config = configparser.RawConfigParser()
         self._config.read([board_config])
@@ -295,6 +2010,8 @@ class BoardConfig(object):
             archive_prefix = None
             if self._config.has_option(section, 'archive_prefix'):
                 archive_prefix = self._config.get(section, 'archive_prefix')
+            package_args = dict(parent=parent, template=template, name=section,
+                archive_prefix=archive_prefix)
             # Look for a directory or repo and process accordingly.
             if self._config.has_option(section, 'directory') and \
                 self._config.has_option(section, 'repo'):
@@ -303,8 +2020,11 @@ class BoardConfig(object):
             if self._config.has_option(section, 'directory'):
                 # Create a local directory-based package source.
                 directory = self._config.get(section, 'directory')
-                self._packages.append(DirectoryBoardPackage(directory, parent=parent,
-                    template=template, name=section, archive_prefix=archive_prefix))
+                self._locations[section] = ('directory', directory, None)
+                self._sources[section] = functools.partial(DirectoryBoardPackage,
+                    directory, **package_args)
+                self._probes[section] = functools.partial(DirectoryBoardPackage.probe,
+                    directory, **package_args)
             elif self._config.has_option(section, 'repo'):
                 # Create a Git-based package source.
                 repo = self._config.get(section, 'repo')
@@ -312,24 +2032,125 @@ class BoardConfig(object):
                 repo_dir = None
                 if self._config.has_option(section, 'repo_dir'):
                     repo_dir = self._config.get(section, 'repo_dir')
-                self._packages.append(GitBoardPackage(repo, repo_dir, parent=parent,
-                    template=template, name=section, archive_prefix=archive_prefix))
+                # Grab optional ref to package and clone depth.
+                git_args = dict(ref=None, depth=None)
+                if self._config.has_option(section, 'ref'):
+                    git_args['ref'] = self._config.get(section, 'ref')
+                if self._config.has_option(section, 'depth'):
+                    depth = self._config.get(section, 'depth').strip()
+                    if not depth.isdigit() or int(depth) < 1:
+                        raise RuntimeError('Board package config depth must be a positive number of commits!')
+                    git_args['depth'] = int(depth)
+                self._locations[section] = ('repo', repo, git_args['ref'])
+                self._sources[section] = functools.partial(GitBoardPackage,
+                    repo, repo_dir, mirror_cache=mirror_cache, **dict(package_args, **git_args))
+                self._probes[section] = functools.partial(GitBoardPackage.probe,
+                    repo, repo_dir, mirror_cache=mirror_cache, **dict(package_args, **git_args))
             else:
                 # No known way to read this repo, fail.
                 raise RuntimeError('Board package config must specify either directory or repo!')
 
-    def get_packages(self):
-        """Return the packages parsed by this configuration file."""
-        return self._packages
+    def _load_package(self, name):
+        """Create the package with the specified name if it hasn't been created
+        yet and return it.  If another thread is already creating the package
+        wait for it instead of loading the same source twice.
+        """
+        with self._lock:
+            package = self._packages.get(name)
+            if package is not None:
+                return package
+            future = self._loading.get(name)
+            loading = future is None
+            if loading:
+                future = concurrent.futures.Future()
+                self._loading[name] = future
+        if not loading:
+            return future.result()
+        logger.debug('Loading board package {0}'.format(name))
+        try:
+            with profile_phase('load_package', name):
+                package = self._sources[name]()
+        except BaseException as ex:
+            with self._lock:
+                del self._loading[name]
+            future.set_exception(ex)
+            raise
+        with self._lock:
+            self._packages[name] = package
+            del self._loading[name]
+        future.set_result(package)
+        return package
+
+    def get_package_names(self):
+        """Return the names of all the packages in this configuration file
+        without loading them.
+        """
+        return list(self._sources.keys())
+
+    def get_packages(self, names=None):
+        """Return the packages parsed by this configuration file, or only the
+        packages with the specified list of names.  Any packages not loaded yet
+        are loaded concurrently.
+        """
+        if names is None:
+            names = self.get_package_names()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            packages = list(executor.map(self._load_package, names))
+        return packages
+
+    def get_package_source(self, name):
+        """Return a tuple of where the package with the specified name comes
+        from: the kind of source ('directory' or 'repo'), the directory path or
+        repository URL, and the Git ref (or None).
+        """
+        return self._locations[name]
+
+    def probe_package(self, name):
+        """Return a BoardPackage for the package with the specified name that
+        only has its name, version and origin filled in, like probe_packages.
+        """
+        with self._lock:
+            package = self._packages.get(name)
+        if package is not None:
+            return package
+        logger.debug('Probing board package {0}'.format(name))
+        with profile_phase('probe', name):
+            return self._probes[name]()
+
+    def probe_packages(self, names=None):
+        """Return a BoardPackage for each package in this configuration file,
+        or only the packages with the specified list of names, that only has
+        its name, version and origin filled in.  This is much faster than
+        get_packages for Git packages as no working tree is checked out, but
+        the returned packages can't be archived.  Packages that were already
+        fully loaded are returned as is.
+        """
+        if names is None:
+            names = self.get_package_names()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            packages = list(executor.map(self.probe_package, names))
+        return packages
 
     def get_package(self, package):
         """Return the specified package (by name), or None if it does not exist
         in the config.
         """
-        packages = list(filter(lambda x: x.get_name() == package, self._packages))
-        if len(packages) == 0:
+        if package not in self._sources:
             return None
-        elif len(packages) == 1:
-            return packages[0]
-        else:
-            raise RuntimeError('Found multiple packages with same name in config, ambiguous result!')
+        return self._load_package(package)
+
+    def unload_packages(self, names=None):
+        """Close the loaded packages, or only the loaded packages with the
+        specified list of names, so they're loaded again from their origin the
+        next time they're requested.
+        """
+        with self._lock:
+            if names is None:
+                names = list(self._packages.keys())
+            packages = [self._packages.pop(x) for x in names if x in self._packages]
+        for package in packages:
+            package.close()
+
+    def close(self):
+        """Close all the packages that were loaded from this configuration."""
+        self.unload_packages()
@@ -0,0 +1,282 @@
+# Adafruit Arduino Board Package Tool (bpt) Test Server
+# Threaded HTTP server used by bpt's test_server command to serve a board index
+# and its package archives to Arduino clients, plus a small load benchmark
+# client to measure it.
+#
+# Copyright (c) 2016 Adafruit Industries
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import email.utils
+import functools
+import hashlib
+import http.client
+import http.server
+import logging
+import os
+import re
+import threading
+import time
+import urllib.parse
+
+
+logger = logging.getLogger(__name__)
+
+
+class BoardIndexRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Request handler that serves files from memory or from the server's
+    directory with HTTP/1.1 keep-alive, byte ranges and ETag validation.
+    Files on disk are sent with sendfile so their data never passes through
+    Python.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        """Serve a GET request."""
+        self._serve(send_body=True)
+
+    def do_HEAD(self):
+        """Serve a HEAD request."""
+        self._serve(send_body=False)
+
+    def _serve(self, send_body):
+        """Serve the requested path from memory or disk."""
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        memory_file = self.server.get_memory_file(path)
+        if memory_file is not None:
+            data, etag, content_type = memory_file
+            ranges = self._send_headers(len(data), etag, content_type, None)
+            if ranges is not None and send_body:
+                start, end = ranges
+                self.wfile.write(data[start:end])
+            return
+        file_path = self.translate_path(self.path)
+        if os.path.isdir(file_path):
+            # Let the base class handle directory redirects and listings.
+            if send_body:
+                super(BoardIndexRequestHandler, self).do_GET()
+            else:
+                super(BoardIndexRequestHandler, self).do_HEAD()
+            return
+        try:
+            source = open(file_path, 'rb')
+        except OSError:
+            self.send_error(404, 'File not found')
+            return
+        with source:
+            stat = os.fstat(source.fileno())
+            etag = '"{0:x}-{1:x}"'.format(stat.st_size, stat.st_mtime_ns)
+            ranges = self._send_headers(stat.st_size, etag, self.guess_type(file_path),
+                stat.st_mtime)
+            if ranges is not None and send_body:
+                start, end = ranges
+                if end > start:
+                    self.connection.sendfile(source, start, end - start)
+
+    def _parse_range(self, size, etag):
+        """Parse the Range header of the request for a resource of the
+        specified size and ETag.  Returns None to send the whole resource, a
+        (start, end) tuple for a satisfiable single byte range, or False if the
+        range can't be satisfied.  Multiple ranges aren't supported so the whole
+        resource is sent instead, which clients must accept.
+        """
+        header = self.headers.get('Range')
+        if header is None:
+            return None
+        # Ignore the range if the client's copy is a different version.
+        if_range = self.headers.get('If-Range')
+        if if_range is not None and if_range.strip() != etag:
+            return None
+        match = re.fullmatch(r'\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*', header)
+        if match is None or match.group(1) == match.group(2) == '':
+            return None
+        if match.group(1) == '':
+            # Suffix range of the last N bytes.
+            length = int(match.group(2))
+            if length == 0:
+                return False
+            return (max(size - length, 0), size)
+        start = int(match.group(1))
+        end = size if match.group(2) == '' else min(int(match.group(2)) + 1, size)
+        if start >= size or end <= start:
+            return False
+        return (start, end)
+
+    def _send_headers(self, size, etag, content_type, mtime):
+        """Send the status and headers for a resource of the specified size,
+        ETag, content type and modification time (or None).  Returns the
+        (start, end) byte range of the body to send, or None if no body should
+        be sent.
+        """
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None and \
+            (if_none_match.strip() == '*' or etag in map(str.strip, if_none_match.split(','))):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+        byte_range = self._parse_range(size, etag)
+        if byte_range is False:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */{0}'.format(size))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+        if byte_range is None:
+            self.send_response(200)
+            byte_range = (0, size)
+        else:
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(byte_range[0],
+                byte_range[1] - 1, size))
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(byte_range[1] - byte_range[0]))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        if mtime is not None:
+            self.send_header('Last-Modified', email.utils.formatdate(mtime, usegmt=True))
+        self.end_headers()
+        return byte_range
+
+
+class SourceMemoryFile(object):
+    """File served from memory whose bytes are built from a source file on
+    disk.  The bytes and their ETag are computed once and only rebuilt when
+    the source file's modification time or size changes.
+    """
+
+    def __init__(self, source_file, build, content_type='application/octet-stream'):
+        """Initialize memory file built from the specified source file path by
+        calling build, which should return the bytes to serve.
+        """
+        self._source_file = source_file
+        self._build = build
+        self._content_type = content_type
+        self._source_stat = None
+        self._entry = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Return a (data, ETag, content type) tuple for the current contents,
+        rebuilding them first if the source file changed.
+        """
+        stat = os.stat(self._source_file)
+        source_stat = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            if source_stat != self._source_stat:
+                logger.debug('Building {0} from source file {1}'.format(self._content_type, self._source_file))
+                data = self._build()
+                etag = '"{0}"'.format(hashlib.sha256(data).hexdigest()[:32])
+                self._entry = (data, etag, self._content_type)
+                self._source_stat = source_stat
+            return self._entry
+
+
+class BoardIndexServer(http.server.ThreadingHTTPServer):
+    """HTTP server that handles each connection in its own thread.  Serves
+    files registered in memory (like a transformed board index) and otherwise
+    files from a directory (like the board package archives).
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, directory):
+        """Initialize server listening on the specified (host, port) address
+        that serves files from the specified directory.
+        """
+        handler = functools.partial(BoardIndexRequestHandler, directory=directory)
+        super(BoardIndexServer, self).__init__(address, handler)
+        self._memory_files = {}
+        self._memory_lock = threading.Lock()
+
+    def add_memory_file(self, path, data, content_type='application/octet-stream'):
+        """Serve the specified bytes at the URL path (like '/index.json')."""
+        etag = '"{0}"'.format(hashlib.sha256(data).hexdigest()[:32])
+        entry = (data, etag, content_type)
+        with self._memory_lock:
+            self._memory_files[path] = lambda: entry
+
+    def add_source_memory_file(self, path, source_file, build, content_type='application/octet-stream'):
+        """Serve bytes built from a source file at the URL path.  The bytes are
+        returned by calling build and only rebuilt when the source file changes.
+        """
+        memory_file = SourceMemoryFile(source_file, build, content_type)
+        with self._memory_lock:
+            self._memory_files[path] = memory_file.get
+
+    def get_memory_file(self, path):
+        """Return a (data, ETag, content type) tuple for the file at the URL
+        path, or None if there is no such file in memory.
+        """
+        with self._memory_lock:
+            memory_file = self._memory_files.get(path)
+        if memory_file is None:
+            return None
+        return memory_file()
+
+
+def run_load_benchmark(url, clients, requests):
+    """Measure how fast the server at url serves it to the specified number of
+    concurrent clients, each making the specified number of requests over one
+    keep-alive connection.  Returns a dict with the total requests, failed
+    requests, bytes received, elapsed seconds and sorted list of request
+    latencies in seconds.
+    """
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+    results = {'requests': 0, 'failed': 0, 'bytes': 0, 'latencies': []}
+    results_lock = threading.Lock()
+    def client():
+        connection = connection_class(parts.hostname, parts.port)
+        latencies = []
+        failed = 0
+        received = 0
+        try:
+            for i in range(requests):
+                start = time.perf_counter()
+                try:
+                    connection.request('GET', path)
+                    response = connection.getresponse()
+                    received += len(response.read())
+                    if response.status != 200:
+                        failed += 1
+                except (OSError, http.client.HTTPException) as ex:
+                    logger.debug('Benchmark request failed: {0}'.format(ex))
+                    failed += 1
+                    connection.close()
+                latencies.append(time.perf_counter() - start)
+        finally:
+            connection.close()
+        with results_lock:
+            results['requests'] += len(latencies)
+            results['failed'] += failed
+            results['bytes'] += received
+            results['latencies'].extend(latencies)
+    threads = [threading.Thread(target=client) for i in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results['elapsed'] = time.perf_counter() - start
+    results['latencies'].sort()
+    return results
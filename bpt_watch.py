@@ -0,0 +1,394 @@
+# Adafruit Arduino Board Package Tool (bpt) Watcher
+# Long running process used by bpt's watch command.  Keeps the board package
+# config, board index and Git mirrors loaded, checks the board packages for new
+# versions in a loop and only rebuilds the ones that changed, with a small local
+# HTTP API to report its status and trigger checks.
+#
+# Copyright (c) 2016 Adafruit Industries
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import concurrent.futures
+import http.server
+import json
+import logging
+import os
+import threading
+import time
+import urllib.parse
+
+from bpt_model import GitBoardPackage, build_platform, parse_version
+
+
+logger = logging.getLogger(__name__)
+
+
+def _timestamp(seconds=None):
+    """Return the specified time in seconds since the epoch (or now) as an
+    ISO 8601 UTC string.
+    """
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(seconds))
+
+
+def _file_fingerprint(path):
+    """Return a tuple of the modification time and size of the file at path,
+    or None if it doesn't exist.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+class BoardIndexWatcher(object):
+    """Watches the board packages of a config file and keeps the board index up
+    to date with them.  The config and index are loaded once and kept in
+    memory.  Each check only looks at packages whose source might have changed:
+    directory packages whose platform.txt was modified and Git packages whose
+    remote ref moved, which is polled less often.  Only packages that now have a
+    newer version than the index are rebuilt, and the index is written once
+    with all of them.  A package that fails is only tried again when its source
+    changes or a check is forced.  The config and index are loaded again if
+    their files are changed by something else.
+    """
+
+    def __init__(self, load_config, read_index, board_config_file, board_index_file,
+                 output_board_index, output_board_dir, interval=2, git_interval=300,
+                 jobs=4, archive_args=None, echo=None):
+        """Initialize watcher of the board packages in board_config_file that
+        updates the board index read from board_index_file, writing it to
+        output_board_index and the archives to output_board_dir.  load_config
+        and read_index are called to load the BoardConfig and BoardIndex.
+        Checks run every interval seconds and Git remotes are polled every
+        git_interval seconds.  Up to jobs packages are probed or built at once,
+        and archive_args are passed to build_platform.  Progress messages are
+        passed to the echo function if specified.
+        """
+        self._load_config = load_config
+        self._read_index = read_index
+        self._board_config_file = board_config_file
+        self._board_index_file = board_index_file
+        self._output_board_index = output_board_index
+        self._output_board_dir = output_board_dir
+        self._interval = interval
+        self._git_interval = git_interval
+        self._jobs = jobs
+        self._archive_args = archive_args or {}
+        self._echo = echo or (lambda message: None)
+        self._config = None
+        self._config_fingerprint = None
+        self._index = None
+        self._index_fingerprint = None
+        # Public status of each package, and the fingerprint of its source and
+        # when its Git remote was last polled which are only used internally.
+        self._packages = {}
+        self._fingerprints = {}
+        self._polled = {}
+        # The status lock guards everything the control API reads, the run lock
+        # makes sure only one check runs at a time.
+        self._lock = threading.Lock()
+        self._run_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._force = False
+        self._stopping = False
+        self._state = 'idle'
+        self._started = _timestamp()
+        self._runs = 0
+        self._last_run = None
+
+    def _update_package(self, name, **values):
+        """Update the public status of the package with the specified name."""
+        with self._lock:
+            self._packages[name].update(values)
+
+    def _reload(self):
+        """Load the config and index if they haven't been loaded yet or their
+        files changed since they were loaded.
+        """
+        fingerprint = _file_fingerprint(self._board_config_file)
+        if self._config is None or fingerprint != self._config_fingerprint:
+            if self._config is not None:
+                self._echo('Board package config changed, reloading {0}'.format(self._board_config_file))
+                self._config.close()
+            self._config = self._load_config()
+            self._config_fingerprint = fingerprint
+            self._fingerprints = {}
+            self._polled = {}
+            with self._lock:
+                self._packages = dict((x, dict(origin=None, version=None, index_version=None,
+                    checked=None, built=None, error=None)) for x in self._config.get_package_names())
+        fingerprint = _file_fingerprint(self._board_index_file)
+        if self._index is None or fingerprint != self._index_fingerprint:
+            if self._index is not None:
+                self._echo('Board index changed, reloading {0}'.format(self._board_index_file))
+                # Compare every package with the new index.
+                self._fingerprints = {}
+                self._polled = {}
+            self._index = self._read_index()
+            self._index_fingerprint = fingerprint
+
+    def _find_changed(self, force, run):
+        """Return a list of (name, source fingerprint) tuples of the packages
+        whose source changed since they were last checked, or of every package
+        if force is True.
+        """
+        now = time.monotonic()
+        changed = []
+        for name in self._config.get_package_names():
+            kind, location, ref = self._config.get_package_source(name)
+            try:
+                if kind == 'directory':
+                    fingerprint = _file_fingerprint(os.path.join(location, 'platform.txt'))
+                elif force or name not in self._polled or now - self._polled[name] >= self._git_interval:
+                    fingerprint = GitBoardPackage.get_remote_refs(location, ref)
+                    self._polled[name] = now
+                else:
+                    continue
+            except Exception as ex:
+                run['errors'][name] = str(ex)
+                self._update_package(name, error=str(ex))
+                continue
+            if force or name not in self._fingerprints or fingerprint != self._fingerprints[name]:
+                changed.append((name, fingerprint))
+        return changed
+
+    def _probe(self, changed, run):
+        """Read the current version of each changed package and return a list
+        of (name, source fingerprint) tuples of the ones that are newer than
+        the board index.
+        """
+        outdated = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._jobs) as executor:
+            futures = [(name, fingerprint, executor.submit(self._config.probe_package, name))
+                for name, fingerprint in changed]
+        for name, fingerprint, future in futures:
+            try:
+                package = future.result()
+            except Exception as ex:
+                run['errors'][name] = str(ex)
+                self._update_package(name, error=str(ex))
+                self._fingerprints[name] = fingerprint
+                continue
+            run['checked'].append(name)
+            latest = self._index.latest_version(package.get_parent(), name)
+            self._update_package(name, origin=package.get_origin(), version=package.get_version(),
+                index_version=None if latest is None else str(latest), checked=_timestamp(), error=None)
+            # Like update_index --all, packages that aren't in the index yet
+            # have to be added by hand first.
+            if latest is not None and latest < parse_version(package.get_version()):
+                outdated.append((name, fingerprint))
+            else:
+                self._fingerprints[name] = fingerprint
+        return outdated
+
+    def _rebuild(self, outdated, run):
+        """Build the archives of the outdated packages, add them to the board
+        index and write it.
+        """
+        names = [x[0] for x in outdated]
+        self._echo('Rebuilding out of date packages: {0}'.format(', '.join(names)))
+        try:
+            packages = self._config.get_packages(names)
+            if not os.path.exists(self._output_board_dir):
+                os.makedirs(self._output_board_dir)
+            build = lambda x: build_platform(x, self._output_board_dir, **self._archive_args)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self._jobs) as executor:
+                platforms = list(executor.map(build, packages))
+            for package, platform in zip(packages, platforms):
+                self._index.add_platform(package.get_parent(), platform)
+            self._index.write_file(self._output_board_index)
+        except Exception as ex:
+            for name, fingerprint in outdated:
+                run['errors'][name] = str(ex)
+                self._update_package(name, error=str(ex))
+                self._fingerprints[name] = fingerprint
+            raise
+        finally:
+            # Don't keep the working trees of Git packages around.
+            self._config.unload_packages(names)
+        if os.path.abspath(self._output_board_index) == os.path.abspath(self._board_index_file):
+            # Don't reload the index that was just written.
+            self._index_fingerprint = _file_fingerprint(self._board_index_file)
+        for (name, fingerprint), package in zip(outdated, packages):
+            self._fingerprints[name] = fingerprint
+            self._update_package(name, version=package.get_version(), index_version=package.get_version(),
+                built=_timestamp())
+            run['rebuilt'].append(name)
+            self._echo('Created board package archive: {0}'.format(
+                os.path.join(self._output_board_dir, package.get_archive_name())))
+        self._echo('Wrote updated board index JSON: {0}'.format(self._output_board_index))
+
+    def run_once(self, force=False):
+        """Check the packages for changes and rebuild the ones that are newer
+        than the board index.  If force is True every package is probed again
+        even if its source looks unchanged.  Returns a dict that describes the
+        run.
+        """
+        with self._run_lock:
+            run = {'started': _timestamp(), 'force': force, 'checked': [], 'rebuilt': [], 'errors': {},
+                'error': None}
+            with self._lock:
+                self._state = 'running'
+            try:
+                self._reload()
+                changed = self._find_changed(force, run)
+                if len(changed) > 0:
+                    logger.debug('Checking changed packages: {0}'.format(', '.join(x[0] for x in changed)))
+                    outdated = self._probe(changed, run)
+                    if len(outdated) > 0:
+                        self._rebuild(outdated, run)
+            except Exception as ex:
+                logger.debug('Watcher run failed', exc_info=True)
+                run['error'] = str(ex)
+            run['finished'] = _timestamp()
+            for name, error in run['errors'].items():
+                self._echo('Error checking {0}: {1}'.format(name, error))
+            if run['error'] is not None and len(run['errors']) == 0:
+                self._echo('Error: {0}'.format(run['error']))
+            with self._lock:
+                self._state = 'idle'
+                self._runs += 1
+                self._last_run = run
+            return run
+
+    def run_forever(self):
+        """Run checks every interval seconds, or as soon as one is triggered,
+        until stop is called.
+        """
+        while True:
+            self._wakeup.clear()
+            with self._lock:
+                if self._stopping:
+                    break
+                force = self._force
+                self._force = False
+            self.run_once(force)
+            self._wakeup.wait(self._interval)
+
+    def trigger(self, force=False):
+        """Make run_forever start a check now instead of waiting for the
+        interval.  If force is True every package is probed again.
+        """
+        with self._lock:
+            self._force = self._force or force
+        self._wakeup.set()
+
+    def stop(self):
+        """Make run_forever return once the current check is done."""
+        with self._lock:
+            self._stopping = True
+        self._wakeup.set()
+
+    def get_status(self):
+        """Return a dict with the status of the watcher and its packages that
+        can be serialized to JSON.
+        """
+        with self._lock:
+            return {
+                'state': 'stopping' if self._stopping else self._state,
+                'started': self._started,
+                'runs': self._runs,
+                'board_config': self._board_config_file,
+                'board_index': self._output_board_index,
+                'interval': self._interval,
+                'git_interval': self._git_interval,
+                'last_run': self._last_run,
+                'packages': dict((k, dict(v)) for k, v in self._packages.items())
+            }
+
+    def close(self):
+        """Close the packages loaded from the config."""
+        if self._config is not None:
+            self._config.close()
+
+
+class WatchRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Request handler of the watcher's control API:
+      - GET /status returns the status of the watcher and its packages.
+      - POST /run starts a check now.  With ?force=1 every package is probed
+        again, and with ?wait=1 the response is sent when the check is done
+        and describes it.
+      - POST /stop stops the watcher.
+    All responses are JSON.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        """Serve a GET request."""
+        path = urllib.parse.urlsplit(self.path).path
+        if path == '/status':
+            self._send_json(200, self.server.watcher.get_status())
+        else:
+            self._send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        """Serve a POST request."""
+        parts = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(parts.query)
+        flag = lambda name: query.get(name, [''])[-1].lower() in ('1', 'true', 'yes')
+        # Discard any body so the connection can be kept alive.
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > 0:
+            self.rfile.read(length)
+        watcher = self.server.watcher
+        if parts.path == '/run':
+            if flag('wait'):
+                self._send_json(200, watcher.run_once(force=flag('force')))
+            else:
+                watcher.trigger(force=flag('force'))
+                self._send_json(202, {'triggered': True, 'force': flag('force')})
+        elif parts.path == '/stop':
+            watcher.stop()
+            self._send_json(202, {'stopping': True})
+        else:
+            self._send_json(404, {'error': 'Not found'})
+
+    def _send_json(self, status, data):
+        """Send a response with the specified status and data as JSON."""
+        body = json.dumps(data, indent=2, sort_keys=True).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Log requests at debug level instead of printing them."""
+        logger.debug('Control API {0} {1}'.format(self.address_string(), format % args))
+
+
+class WatchControlServer(http.server.ThreadingHTTPServer):
+    """HTTP server of the control API of a BoardIndexWatcher, which handles
+    each connection in its own thread.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, watcher):
+        """Initialize server listening on the specified (host, port) address
+        that controls the specified BoardIndexWatcher.
+        """
+        super(WatchControlServer, self).__init__(address, WatchRequestHandler)
+        self.watcher = watcher
+
+    def start(self):
+        """Serve requests in a background thread until shutdown is called."""
+        thread = threading.Thread(target=self.serve_forever, name='bpt-control')
+        thread.daemon = True
+        thread.start()
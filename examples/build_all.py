@@ -1,17 +1,23 @@
+import argparse
+import concurrent.futures
+import hashlib
+import itertools
+import json
 import os
+import queue
+import re
 import shutil
 import sys
 import subprocess
+import tempfile
 import time
-
-success_count = 0
-fail_count = 0
-exit_status = 0
+from xml.etree import ElementTree
 
 build_format = '| {:55} | {:9} '
 build_separator = '-' * 79
 
 SKETCH = 'examples/test/test.ino'
+BOARD_INDEX = 'package_adafruit_index.json'
 
 all_boards = [
     # AVR Boards
@@ -30,7 +36,7 @@ all_boards = [
     'adafruit:avr:itsybitsy32u4_5V',
     'adafruit:avr:itsybitsy32u4_3V',
     'adafruit:avr:adafruit32u4',
-    
+
     # SAMD M0 Boards
     'adafruit:samd:adafruit_feather_m0',
     'adafruit:samd:adafruit_feather_m0_express',
@@ -38,18 +44,18 @@ all_boards = [
     'adafruit:samd:adafruit_circuitplayground_m0',
     'adafruit:samd:adafruit_gemma_m0',
     'adafruit:samd:adafruit_trinket_m0',
-    'adafruit:samd:adafruit_qtpy_m0',    
+    'adafruit:samd:adafruit_qtpy_m0',
     'adafruit:samd:adafruit_neotrinkey_m0',
     'adafruit:samd:adafruit_rotarytrinkey_m0',
     'adafruit:samd:adafruit_neokeytrinkey_m0',
     'adafruit:samd:adafruit_slidetrinkey_m0',
     'adafruit:samd:adafruit_proxlighttrinkey_m0',
     'adafruit:samd:adafruit_itsybitsy_m0',
-    'adafruit:samd:adafruit_pirkey',    
+    'adafruit:samd:adafruit_pirkey',
     'adafruit:samd:adafruit_hallowing',
     'adafruit:samd:adafruit_crickit_m0',
-    'adafruit:samd:adafruit_blm_badge',    
-    
+    'adafruit:samd:adafruit_blm_badge',
+
     # SAMD M4 Boards
     'adafruit:samd:adafruit_metro_m4:speed=120',
     'adafruit:samd:adafruit_grandcentral_m4:speed=120',
@@ -61,12 +67,12 @@ all_boards = [
     'adafruit:samd:adafruit_pyportal_m4_titano:speed=120',
     'adafruit:samd:adafruit_pybadge_m4:speed=120',
     'adafruit:samd:adafruit_metro_m4_airliftlite:speed=120',
-    'adafruit:samd:adafruit_pygamer_m4:speed=120',    
-    'adafruit:samd:adafruit_pybadge_airlift_m4:speed=120',    
+    'adafruit:samd:adafruit_pygamer_m4:speed=120',
+    'adafruit:samd:adafruit_pybadge_airlift_m4:speed=120',
     'adafruit:samd:adafruit_monster_m4sk:speed=120',
-    'adafruit:samd:adafruit_hallowing_m4:speed=120',    
+    'adafruit:samd:adafruit_hallowing_m4:speed=120',
     'adafruit:samd:adafruit_matrixportal_m4:speed=120',
-    
+
     # nRF Boards
     'adafruit:nrf52:feather52832',
     'adafruit:nrf52:feather52840',
@@ -75,34 +81,360 @@ all_boards = [
     'adafruit:nrf52:cluenrf52840'
 ]
 
-total_time = time.monotonic()
 
-print(build_separator)
-print((build_format + '| {:5} |').format('Board', 'Result', 'Time'))
-print(build_separator)
+def load_history(path):
+    """Load the per-board build durations from a previous JSON report, or an
+    empty dict if there is no report.
+    """
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path, 'r') as report:
+        results = json.load(report).get('results', [])
+    return dict((x['board'], x['duration']) for x in results if not x.get('cached'))
+
+
+def version_key(version):
+    """Sort key for a platform version string like '1.7.14'."""
+    return [(0, int(x), '') if x.isdigit() else (1, 0, x) for x in version.replace('-', '.').split('.')]
+
+
+def load_index(path, ref=None):
+    """Load a board index file, or the version of it at a git ref.  Returns
+    None if the file doesn't exist at the ref.
+    """
+    if ref is None:
+        with open(path, 'r') as index:
+            return json.load(index)
+    show = subprocess.run(['git', 'show', '{}:{}'.format(ref, path)], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if show.returncode != 0:
+        return None
+    return json.loads(show.stdout)
+
+
+def core_platforms(index):
+    """Return a dict of the platform entries of each core ('packager:arch') in
+    a board index.
+    """
+    platforms = {}
+    for package in index.get('packages', []):
+        for platform in package.get('platforms', []):
+            core = '{}:{}'.format(package.get('name'), platform.get('architecture'))
+            platforms.setdefault(core, []).append(platform)
+    return platforms
+
+
+def latest_platforms(index):
+    """Return a dict of the latest platform entry of each core in a board
+    index.
+    """
+    return dict((core, max(platforms, key=lambda x: version_key(x.get('version', ''))))
+                for core, platforms in core_platforms(index).items())
+
+
+def index_core_versions(index):
+    """Return a dict of the latest version of each core ('packager:arch') in a
+    board index.
+    """
+    return dict((core, platform.get('version', '')) for core, platform in latest_platforms(index).items())
+
+
+def index_core_entries(index):
+    """Return a dict of a hash of the latest platform entry of each core
+    ('packager:arch') in a board index, which changes when the entry is edited
+    without bumping its version.
+    """
+    return dict((core, hashlib.sha256(json.dumps(platform, sort_keys=True).encode('utf-8')).hexdigest())
+                for core, platform in latest_platforms(index).items())
+
+
+def affected_cores(index, base_index):
+    """Return the set of cores that gained or changed platform entries in the
+    board index compared to the base board index.
+    """
+    canonical = lambda platforms: sorted(json.dumps(x, sort_keys=True) for x in platforms)
+    base_platforms = core_platforms(base_index) if base_index is not None else {}
+    return set(core for core, platforms in core_platforms(index).items()
+               if canonical(platforms) != canonical(base_platforms.get(core, [])))
+
+
+def board_name_key(name):
+    """Normalize a board name for matching index names to boards.txt names,
+    ignoring case, punctuation and a trailing note in parentheses.
+    """
+    return re.sub('[^a-z0-9]', '', re.sub(r'\s*\([^)]*\)\s*$', '', name).lower())
+
+
+def index_boards(index, cores, arduino_cli):
+    """Return the FQBNs of the boards listed in the latest platform entry of
+    each of the cores in the board index.  Board names are mapped to board IDs
+    with the boards arduino-cli reports for the installed core.  Also returns
+    a list of the problems with cores that aren't installed and board names
+    that couldn't be mapped, whose boards are skipped.
+    """
+    boards = []
+    problems = []
+    latest = latest_platforms(index)
+    for core in sorted(cores):
+        listall = subprocess.run([arduino_cli, 'board', 'listall', core, '--format', 'json'],
+                                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        installed = json.loads(listall.stdout or b'{}') if listall.returncode == 0 else {}
+        installed = [x for x in (installed.get('boards') or []) if x.get('fqbn', '').startswith(core + ':')]
+        if len(installed) == 0:
+            problems.append('core {} is not installed, skipping its boards'.format(core))
+            print('Warning: ' + problems[-1])
+            continue
+        for board in latest[core].get('boards', []):
+            key = board_name_key(board.get('name', ''))
+            matches = [x['fqbn'] for x in installed if board_name_key(x['name']) == key]
+            # Fall back to a unique prefix match, like an index name that leaves
+            # off a suffix such as 'Express'.
+            if len(matches) == 0:
+                matches = [x['fqbn'] for x in installed if board_name_key(x['name']).startswith(key)]
+            if len(matches) != 1:
+                problems.append('could not find board ID for "{}" in core {}'.format(board.get('name'), core))
+                print('Warning: ' + problems[-1])
+                continue
+            if matches[0] not in boards:
+                boards.append(matches[0])
+    return boards, problems
+
+
+def installed_core_versions(arduino_cli):
+    """Return a dict of the installed version of each core ('packager:arch')
+    reported by arduino-cli.
+    """
+    output = subprocess.run([arduino_cli, 'core', 'list', '--format', 'json'], check=True,
+                            stdout=subprocess.PIPE).stdout
+    platforms = json.loads(output or b'[]')
+    # Newer arduino-cli versions wrap the list in an object.
+    if isinstance(platforms, dict):
+        platforms = platforms.get('platforms') or []
+    return dict((x['id'], x.get('installed_version', x.get('installed'))) for x in platforms)
 
-for board in all_boards:
-    start_time = time.monotonic()
-    make_result = subprocess.run("arduino-cli compile --fqbn {} {}".format(board, SKETCH), shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    build_duration = time.monotonic() - start_time
 
-    if make_result.returncode == 0:
-        success = "\033[32msucceeded\033[0m"
-        success_count += 1
+def sketch_hash(sketch):
+    """Return a hash of all the files in the sketch's folder."""
+    sketch_dir = os.path.dirname(os.path.abspath(sketch))
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(sketch_dir):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            digest.update(os.path.relpath(path, sketch_dir).replace(os.sep, '/').encode('utf-8') + b'\0')
+            with open(path, 'rb') as source:
+                digest.update(source.read())
+    return digest.hexdigest()
+
+
+def cache_key(board, sketch_digest, core_versions, core_entries):
+    """Return the build cache key for a board, or None if the version of its
+    core is unknown.  The key includes the hash of the core's latest index
+    entry (if it's in the index) so edits to the entry invalidate it.
+    """
+    core = ':'.join(board.split(':')[:2])
+    core_version = core_versions.get(core)
+    if core_version is None:
+        return None
+    return hashlib.sha256('\0'.join([board, sketch_digest, core_version,
+                                     core_entries.get(core, '')]).encode('utf-8')).hexdigest()
+
+
+def load_cache(path):
+    """Load the build result cache, or an empty dict if there is none."""
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path, 'r') as cache:
+        return json.load(cache)
+
+
+def compile_board(board, build_paths, arduino_cli):
+    """Compile the sketch for a board using a build path that no other build
+    is using at the same time.  Returns the board's result dict.
+    """
+    build_path = build_paths.get()
+    try:
+        start_time = time.monotonic()
+        try:
+            make_result = subprocess.run([arduino_cli, 'compile', '--fqbn', board, '--build-path', build_path, SKETCH],
+                                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            returncode = make_result.returncode
+            output = make_result.stdout.decode('utf-8', errors='replace')
+        except OSError as ex:
+            # A missing or broken arduino-cli fails the board instead of the
+            # whole run, the same as when it ran through the shell.
+            returncode = 127
+            output = 'Failed to run {}: {}'.format(arduino_cli, ex)
+        build_duration = time.monotonic() - start_time
+    finally:
+        build_paths.put(build_path)
+    return {
+        'board': board,
+        'returncode': returncode,
+        'duration': build_duration,
+        'output': output
+    }
+
+
+def write_junit(path, results, total_time):
+    """Write the build results as a JUnit XML report."""
+    failures = len([x for x in results if x['returncode'] != 0])
+    skipped = len([x for x in results if x.get('cached')])
+    suite = ElementTree.Element('testsuite', name='build_all', tests=str(len(results)),
+                                failures=str(failures), skipped=str(skipped), time='{:.2f}'.format(total_time))
+    for result in results:
+        case = ElementTree.SubElement(suite, 'testcase', classname=result['board'].split(':')[1],
+                                      name=result['board'], time='{:.2f}'.format(result['duration']))
+        if result.get('cached'):
+            ElementTree.SubElement(case, 'skipped', message='unchanged since a cached successful build')
+        elif result['returncode'] != 0:
+            failure = ElementTree.SubElement(case, 'failure',
+                                             message='arduino-cli exited with {}'.format(result['returncode']))
+            failure.text = result['output']
+    ElementTree.ElementTree(suite).write(path, encoding='utf-8', xml_declaration=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compile the test sketch for every board.')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1,
+                        help='number of boards to compile at the same time (default: number of CPU cores)')
+    parser.add_argument('--arduino-cli', default='arduino-cli',
+                        help='arduino-cli executable to compile with (default: arduino-cli)')
+    parser.add_argument('--report', help='write a JSON report with per-board results and timings to this file')
+    parser.add_argument('--junit', help='write a JUnit XML report to this file')
+    parser.add_argument('--history', help='JSON report of a previous run, boards that took longest are started first')
+    parser.add_argument('--cache', help='file to cache successful builds in, boards whose sketch and core version are unchanged are skipped')
+    parser.add_argument('--core-versions', choices=['index', 'installed'], default='index',
+                        help='take core versions for the cache from the board index or from the cores installed in arduino-cli (default: index)')
+    parser.add_argument('--force', action='store_true', help='rebuild every board even if it is in the cache')
+    parser.add_argument('--boards-from', choices=['list', 'index'], default='list',
+                        help='build the boards in the list in this script, or the boards listed in the board index mapped to board IDs with arduino-cli (default: list)')
+    parser.add_argument('--base', help='git ref of the base board index, only build boards of cores whose platform entries changed since then')
+    parser.add_argument('--strict', action='store_true',
+                        help='with --boards-from index, fail if a core is not installed or a board name can not be mapped to a board ID')
+    parser.add_argument('--head', help='git ref of the board index to compare with --base and take boards from (default: the board index in the working tree)')
+    args = parser.parse_args()
+
+    # Find the cores to build and their boards.
+    index = load_index(BOARD_INDEX, args.head)
+    cores = set(core_platforms(index).keys())
+    if args.base:
+        cores = affected_cores(index, load_index(BOARD_INDEX, args.base))
+        print('Cores changed since {}: {}'.format(args.base, ', '.join(sorted(cores)) or 'none'))
+    problems = []
+    if args.boards_from == 'index':
+        boards, problems = index_boards(index, cores, args.arduino_cli)
     else:
-        exit_status = make_result.returncode
-        success = "\033[31mfailed\033[0m   "
-        fail_count += 1
+        boards = [x for x in all_boards if ':'.join(x.split(':')[:2]) in cores]
+
+    success_count = 0
+    cached_count = 0
+    fail_count = 0
+    exit_status = 0
+
+    # Skip boards that already built successfully with the same sketch and core
+    # version.
+    results = {}
+    keys = {}
+    cache = {}
+    if args.cache:
+        if args.core_versions == 'installed':
+            core_versions = installed_core_versions(args.arduino_cli)
+        else:
+            core_versions = index_core_versions(index)
+        sketch_digest = sketch_hash(SKETCH)
+        # Use the same index the boards come from, which is the one at --head
+        # if specified and not the working tree file.
+        core_entries = index_core_entries(index)
+        keys = dict((board, cache_key(board, sketch_digest, core_versions, core_entries)) for board in boards)
+        cache = load_cache(args.cache)
+        for board in boards:
+            if not args.force and keys[board] is not None and keys[board] in cache:
+                results[board] = {'board': board, 'returncode': 0, 'duration': 0.0, 'output': '', 'cached': True}
+
+    # Start the slowest boards first so they don't end up running alone at the
+    # end of the build.  Boards without a previous duration go first.
+    history = load_history(args.history)
+    schedule = sorted([x for x in boards if x not in results], key=lambda x: -history.get(x, float('inf')))
+
+    # Each worker gets its own build path so builds don't collide.
+    jobs = max(args.jobs, 1)
+    build_root = tempfile.mkdtemp(prefix='build_all-')
+    build_paths = queue.Queue()
+    for i in range(jobs):
+        build_paths.put(os.path.join(build_root, str(i)))
+
+    total_time = time.monotonic()
+
+    print(build_separator)
+    print((build_format + '| {:5} |').format('Board', 'Result', 'Time'))
+    print(build_separator)
+
+    printed = 0
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(compile_board, board, build_paths, args.arduino_cli) for board in schedule]
+            # Also go through the loop once up front to print cached results.
+            for future in itertools.chain([None], concurrent.futures.as_completed(futures)):
+                if future is not None:
+                    result = future.result()
+                    results[result['board']] = result
+                # Print finished results in the same order as the board list.
+                while printed < len(boards) and boards[printed] in results:
+                    result = results[boards[printed]]
+                    printed += 1
+
+                    if result.get('cached'):
+                        success = "\033[33mcached\033[0m   "
+                        cached_count += 1
+                    elif result['returncode'] == 0:
+                        success = "\033[32msucceeded\033[0m"
+                        success_count += 1
+                    else:
+                        exit_status = result['returncode']
+                        success = "\033[31mfailed\033[0m   "
+                        fail_count += 1
+
+                    print((build_format + '| {:.2f}s |').format(result['board'], success, result['duration']))
+
+                    if result['returncode'] != 0:
+                        print(result['output'])
+                    sys.stdout.flush()
+    finally:
+        shutil.rmtree(build_root, ignore_errors=True)
+
+    # Build Summary
+    total_time = time.monotonic() - total_time
+    print(build_separator)
+    print("Build Sumamary: {} \033[32msucceeded\033[0m, {} \033[33mcached\033[0m, {} \033[31mfailed\033[0m and took {:.2f}s".format(success_count, cached_count, fail_count, total_time))
+    print(build_separator)
+
+    # Replace the cache entries of the boards in this run with their successful
+    # builds, and keep the entries of boards this run didn't touch (like those
+    # of cores that didn't change since --base).
+    if args.cache:
+        cache = dict((key, entry) for key, entry in cache.items() if entry.get('board') not in keys)
+        cache.update((keys[board], {'board': board}) for board in boards
+                     if keys[board] is not None and results[board]['returncode'] == 0)
+        with open(args.cache, 'w') as cache_file:
+            json.dump(cache, cache_file, indent=2)
+
+    ordered_results = [results[board] for board in boards]
+    if args.report:
+        with open(args.report, 'w') as report:
+            json.dump({'total_time': total_time, 'jobs': jobs, 'results': ordered_results}, report, indent=2)
+    if args.junit:
+        write_junit(args.junit, ordered_results, total_time)
 
-    print((build_format + '| {:.2f}s |').format(board, success, build_duration))
+    # Boards that were skipped count as failures in strict mode, otherwise the
+    # build could pass without building some or even all of them.
+    if args.strict and len(problems) > 0:
+        print('Error: {} problems finding the boards to build:'.format(len(problems)))
+        for problem in problems:
+            print('  ' + problem)
+        exit_status = exit_status or 1
 
-    if make_result.returncode != 0:
-        print(make_result.stdout.decode("utf-8"))
+    sys.exit(exit_status)
 
-# Build Summary
-total_time = time.monotonic() - total_time
-print(build_separator)
-print("Build Sumamary: {} \033[32msucceeded\033[0m, {} \033[31mfailed\033[0m and took {:.2f}s".format(success_count, fail_count, total_time))
-print(build_separator)
 
-sys.exit(exit_status)
+if __name__ == '__main__':
+    main()